@@ -1,18 +1,86 @@
 from marto_python.admin import register_admin
-from .models import Chat
+from .models import Chat, PendingMessage, Delivery, StoredLesson, BotJob, ConversationState, ChatData
+from .chat_cache import chat_cache
+from django.contrib import admin
 from django.contrib.admin import ModelAdmin
-# from asgiref.sync import async_to_sync
-# from . import bot_updates
 
 
 class ChatAdmin(ModelAdmin):
-    list_display = ['pk', 'chat_id', 'username', 'is_group', 'send_lesson']
-    # actions = ['retrieve_name']
-    #
-    # def retrieve_name(self, request, queryset):
-    #     async_to_sync(bot_updates.initialize_bot)()  # TODO: find better way to do this, so we don't have to initialize in every action
-    #     for chat in queryset.all():
-    #         async_to_sync(bot_updates.retrieve_chat_name)(chat)
+    list_display = ['pk', 'chat_id', 'username', 'is_group', 'send_lesson', 'timezone', 'send_hour', 'failures']
+    actions = ['refresh_names', 'resend_lesson', 'calendar_mode']
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # only the cache of this process, the other processes re-read the fields their handlers branch on,
+        # see bot.refresh_chat_fields, and the rest after CHAT_CACHE_TTL
+        chat_cache.invalidate(form.initial.get('chat_id'))
+        chat_cache.invalidate(obj.chat_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        chat_cache.invalidate(obj.chat_id)
+
+    def delete_queryset(self, request, queryset):
+        chat_ids = list(queryset.values_list('chat_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for chat_id in chat_ids:
+            chat_cache.invalidate(chat_id)
+
+    @admin.action(description='Refresh the names of the selected chats')
+    def refresh_names(self, request, queryset):
+        self.create_job(request, queryset, BotJob.REFRESH_NAMES)
+
+    @admin.action(description='Resend today\'s lesson to the selected chats')
+    def resend_lesson(self, request, queryset):
+        self.create_job(request, queryset, BotJob.RESEND_LESSON)
+
+    @admin.action(description='Switch the selected chats to calendar mode')
+    def calendar_mode(self, request, queryset):
+        self.create_job(request, queryset, BotJob.CALENDAR_MODE)
+
+    def create_job(self, request, queryset, action):
+        """The bot process runs the job in the background, its progress is shown in the bot jobs list"""
+        from .bot_jobs import create_job  # imports the telegram stack, not needed by the rest of the admin
+        job = create_job(action, queryset.order_by('pk').values_list('chat_id', flat=True))
+        self.message_user(request, f'Job {job.pk} created for {job.total} chats')
+
+
+class PendingMessageAdmin(ModelAdmin):
+    list_display = ['pk', 'chat', 'lesson_number', 'language', 'part', 'attempts', 'next_attempt', 'error']
+
+
+class DeliveryAdmin(ModelAdmin):
+    list_display = ['pk', 'chat', 'date', 'lesson_number', 'part', 'status', 'message_id']
+    list_filter = ['status', 'date']
+
+
+class StoredLessonAdmin(ModelAdmin):
+    list_display = ['pk', 'channel_id', 'lesson_number', 'language', 'part', 'message_id']
+
+
+class BotJobAdmin(ModelAdmin):
+    list_display = ['pk', 'action', 'status', 'progress', 'failed', 'owner', 'created', 'finished']
+    list_filter = ['action', 'status']
+    readonly_fields = ['total', 'done', 'failed', 'cursor', 'owner', 'lease_expires', 'created', 'finished']
+
+    @admin.display(description='progress')
+    def progress(self, job):
+        return f'{job.done + job.failed}/{job.total}'
+
+
+class ConversationStateAdmin(ModelAdmin):
+    list_display = ['pk', 'name', 'key', 'updated']
+    list_filter = ['name']
+
+
+class ChatDataAdmin(ModelAdmin):
+    list_display = ['pk', 'chat_id', 'updated']
 
 
 register_admin(Chat, ChatAdmin)
+register_admin(PendingMessage, PendingMessageAdmin)
+register_admin(Delivery, DeliveryAdmin)
+register_admin(StoredLesson, StoredLessonAdmin)
+register_admin(BotJob, BotJobAdmin)
+register_admin(ConversationState, ConversationStateAdmin)
+register_admin(ChatData, ChatDataAdmin)
@@ -1,6 +1,7 @@
 import os
 import logging
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 logger = logging.getLogger(__name__)
 
@@ -10,6 +11,10 @@ class LessonsConfig(AppConfig):
     name = 'lessons'
 
     def ready(self):
+        from .log import start_log_listener
+        start_log_listener()
+        connection_created.connect(install_query_metrics)
+
         if not os.environ.get('RUN_MAIN'):  # To prevent double running
             return
 
@@ -17,3 +22,9 @@ class LessonsConfig(AppConfig):
         # from threading import Thread
         # from .bot_loop import run_bot_loop
         # Thread(target=lambda: asyncio.run(run_bot_loop())).start()
+
+
+def install_query_metrics(sender, connection, **kwargs):
+    from .metrics import record_query
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
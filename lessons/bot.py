@@ -1,19 +1,36 @@
-import asyncio
 import logging
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from telegram import BotCommand
 from telegram.constants import ParseMode
-from datetime import datetime
+from datetime import datetime, timedelta, time, UTC
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, NetworkError, BadRequest, ChatMigrated
 
-from .workbook import get_day_texts, get_day_lesson_number
-from .models import Chat
+from . import metrics, retry_queue, scheduler, lesson_storage
+from .workbook import get_lesson_messages
+from .send_plan import SendPlan
+from .models import Chat, Delivery, is_valid_timezone
+from .dispatcher import dispatch
+from .write_buffer import chat_writes
+from .deliveries import deliveries
+from .chat_cache import chat_cache
+from .rate_limit import Priority
 
 logger = logging.getLogger(__name__)
 
 bot = None
+broadcast_bot = None  # for sending lessons, see bot_updates.initialize_bot
 application = None
 
+SEND_START_HOUR = 8  # default send hour
+SEND_END_HOUR = 23
+SEND_HOURS_MIN, SEND_HOURS_MAX = 0, SEND_END_HOUR - 1
+
 
 async def set_commands():
     logger.info('Setting bot commands')
@@ -21,15 +38,23 @@ async def set_commands():
         BotCommand('start', 'Comenzar a recibir las lecciones'),
         BotCommand('modo', 'Configurar el modo de las lecciones (calendario o propia)'),
         BotCommand('idioma', 'Configurar el idioma de las lecciones'),
+        BotCommand('hora', 'Configurar la hora y zona horaria de las lecciones'),
         BotCommand('stop', 'Dejar de recibir las lecciones'),
     ]
-    await bot.set_my_commands(commands)
+    try:
+        await bot.set_my_commands(commands)
+    except TelegramError as e:
+        logger.error(f'Error setting bot commands: {e}')
 
 
 async def set_send_lesson(chat, do_send, send_msg=True):
+    await refresh_chat_fields(chat)
     if chat.send_lesson == do_send: return
     chat.send_lesson = do_send
-    await chat.asave()
+    chat.failures = 0
+    chat_writes.add(chat, ['send_lesson', 'failures'])
+    if do_send:  # give some time to choose the lesson mode before sending
+        scheduler.wake(chat.chat_id, delay=settings.SCHEDULER_START_DELAY)
     if send_msg:
         if chat.send_lesson:
             msg = '¡Hola! Soy el bot de lecciones de *Un Curso de Milagros*.\n\nEnvía /start para empezar'
@@ -38,25 +63,43 @@ async def set_send_lesson(chat, do_send, send_msg=True):
         await bot.send_message(chat.chat_id, msg, parse_mode=ParseMode.MARKDOWN)
 
 
-def send_today_shortly(chat):
-    async def task():
-        await asyncio.sleep(3)
-        await do_send_now(chat)
-    asyncio.create_task(task())
-
-
 async def get_chat(chat_id, is_group=None):
-    chat = await Chat.objects.filter(chat_id=chat_id).afirst()
+    chat = chat_writes.get(chat_id) or chat_cache.get(chat_id)
     if not chat:
-        chat = Chat(chat_id=chat_id)
-        await chat.asave()
+        chat = await Chat.objects.filter(chat_id=chat_id).afirst()
+        if not chat:
+            chat = Chat(chat_id=chat_id)
+            await chat.asave()
+        chat_cache.put(chat)
     if is_group is not None and chat.is_group != is_group:
         logger.info(f'{chat} - setting as {"group" if is_group else "chat"}')
         chat.is_group = is_group
-        await chat.asave()
+        chat_writes.add(chat, ['is_group'])
     return chat
 
 
+async def refresh_chat_fields(chat):
+    """
+    Re-reads the fields a handler branches on of a cached chat, which the admin and the processes sending lessons
+    change behind the cache. Fields with changes of this process not yet written are kept.
+    """
+    fields = [field for field in Chat.REFRESH_FIELDS if field not in chat_writes.get_fields(chat.chat_id)]
+    if not fields:
+        return
+    try:
+        await chat.arefresh_from_db(fields=fields)
+    except Chat.DoesNotExist:  # deleted in the admin, created again as for a new chat
+        logger.info(f'{chat} - chat deleted, creating it again')
+        chat.pk = None
+        await chat.asave()
+
+
+async def save_chat(chat, fields):
+    await chat.asave(update_fields=fields)
+    chat_writes.discard(chat, fields)
+    chat_cache.refresh(chat)
+
+
 async def set_lesson_mode(chat_id, is_calendar, lesson_number=None):
     assert is_calendar or lesson_number is not None
     chat = await get_chat(chat_id)
@@ -67,46 +110,238 @@ async def set_lesson_mode(chat_id, is_calendar, lesson_number=None):
         chat.is_calendar = False
         chat.last_lesson_sent = lesson_number - 1
     chat.last_sent = None
-    await chat.asave()
-    send_today_shortly(chat)
+    await save_chat(chat, ['is_calendar', 'last_lesson_sent', 'last_sent'])
+    scheduler.wake(chat.chat_id)
 
 
 async def set_language(chat_id, language):
     assert language is not None
     chat = await get_chat(chat_id)
+    await refresh_chat_fields(chat)
     if chat.language == language:
         return
     chat.language = language
     chat.last_sent = None
     if not chat.is_calendar and chat.last_lesson_sent is not None:
         chat.last_lesson_sent -= 1  # FIXME: This is prone to errors, is there a better way to resend the same lesson?
-    await chat.asave()
-    send_today_shortly(chat)
+    await save_chat(chat, ['language', 'last_sent', 'last_lesson_sent'])
+    scheduler.wake(chat.chat_id)
+
+
+async def set_send_time(chat_id, send_hour, timezone=None):
+    assert SEND_HOURS_MIN <= send_hour <= SEND_HOURS_MAX
+    chat = await get_chat(chat_id)
+    await refresh_chat_fields(chat)
+    chat.send_hour = send_hour
+    if timezone:
+        chat.timezone = timezone
+    await save_chat(chat, ['send_hour', 'timezone'])
+    if can_send_now(chat):
+        scheduler.wake(chat.chat_id)
+    scheduler.schedule_send_all(get_next_send_time(datetime.now(UTC), chat.timezone, chat.send_hour))
 
 
+@metrics.timed(metrics.function_seconds)
 async def try_send_all():
-    chats = [chat async for chat in Chat.objects.filter(send_lesson=True).all() if can_send_now(chat)]
-    logger.info(f'Send all - {len(chats)} chats')
-    for chat in chats:
-        if can_send_now(chat): await do_send_now(chat)
+    """
+    Sends to the due chats of every bucket of chats with the same timezone and send hour, one bucket at a time.
+    """
+    await sweep_failing_chats()
+    now = datetime.now(UTC)
+    plans = {}  # timezone -> SendPlan
+    for timezone, send_hour in await get_send_buckets():
+        local_now = now.astimezone(ZoneInfo(timezone))
+        if not is_send_hour(local_now, send_hour):
+            continue
+        today = local_now.date()
+        if timezone not in plans:
+            plans[timezone] = SendPlan(today)
+        metrics.due_chats.inc(await get_due_chats(today, timezone, send_hour).acount())
+        send = partial(send_due_chat, plan=plans[timezone])
+        stats = await dispatch(iterate_due_chats(today, timezone, send_hour), send)
+        metrics.due_chats.set(0)
+        if stats.chats:
+            logger.info(f'Send all {timezone} {send_hour}h - {stats}')
 
 
-async def do_send_now(chat):
-    if chat.is_calendar:
-        lesson_number = get_day_lesson_number(datetime.now().date())
-    else:
-        lesson_number = (chat.last_lesson_sent + 1) if chat.last_lesson_sent is not None else 0
-        if lesson_number < 0 or lesson_number > 364:
-            lesson_number = 0
-    await send_lesson(chat, lesson_number, language=chat.language)
+async def get_send_buckets():
+    """Buckets with a timezone that is not valid are skipped until it is fixed, so they don't stop the others"""
+    buckets = []
+    async for timezone, send_hour in Chat.objects.filter(send_lesson=True).order_by() \
+            .values_list('timezone', 'send_hour').distinct():
+        if is_valid_timezone(timezone):
+            buckets.append((timezone, send_hour))
+        else:
+            logger.error(f'Not sending to the chats with the invalid timezone "{timezone}"')
+    return buckets
+
+
+async def get_next_send_all_time(now: datetime) -> datetime:
+    times = [get_next_send_time(now, timezone, send_hour) for timezone, send_hour in await get_send_buckets()]
+    return min(times, default=now + timedelta(seconds=settings.SCHEDULER_RESCAN_INTERVAL))
+
+
+def get_next_send_time(now: datetime, timezone, send_hour) -> datetime:
+    """
+    The next start of the send hours for a bucket, in UTC. While inside the send hours, chats are also checked
+    every SCHEDULER_RESCAN_INTERVAL in case some became due without waking the scheduler.
+    """
+    tz = get_zone(timezone)
+    local_now = now.astimezone(tz)
+    if is_send_hour(local_now, send_hour):
+        return now + timedelta(seconds=settings.SCHEDULER_RESCAN_INTERVAL)
+    day = local_now.date() if local_now.hour < send_hour else local_now.date() + timedelta(days=1)
+    return datetime.combine(day, time(send_hour), tzinfo=tz).astimezone(UTC)
+
+
+def get_due_chats(today, timezone, send_hour):
+    return Chat.objects.filter(is_due(today), send_lesson=True, timezone=timezone, send_hour=send_hour) \
+        .only(*Chat.SEND_FIELDS)
+
+
+def is_due(today):
+    return Q(last_sent__isnull=True) | Q(last_sent__lt=today)
+
+
+def is_lease_free(now):
+    return Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+
+
+async def iterate_due_chats(today, timezone, send_hour):
+    """
+    Claims the chats due today in chunks, so that several workers can send at the same time without sending twice.
+    Chats claimed by a worker that crashed are claimed again when their lease expires.
+    Stops when there are no due chats left to claim, a short chunk only means other workers claimed the rest.
+    """
+    seen = set()  # a chat that failed is due again once released, it is retried in the next send all
+    while True:
+        claimed = await claim_due_chats(today, timezone, send_hour)
+        chunk = [chat for chat in claimed if chat.pk not in seen]
+        for chat in claimed:
+            if chat.pk in seen:
+                release_chat(chat)
+        if not chunk:
+            return
+        seen.update(chat.pk for chat in chunk)
+        await deliveries.preload(chunk, today)
+        for chat in chunk:
+            buffered = chat_writes.get(chat.chat_id)  # might have changes not written yet
+            if buffered:
+                buffered.lease_owner, buffered.lease_expires = chat.lease_owner, chat.lease_expires
+                chat = buffered
+            else:
+                chat_cache.refresh(chat)
+            if can_send_today(today, chat):
+                yield chat
+            else:
+                deliveries.discard_preloaded(chat, today)
+                release_chat(chat)
+
+
+@sync_to_async
+def claim_due_chats(today, timezone, send_hour) -> list[Chat]:
+    """
+    Atomically takes the lease of up to SEND_CHUNK_SIZE due chats that no other worker holds.
+    On PostgreSQL the rows being claimed by another worker at the same time are skipped instead of waited for,
+    on SQLite the IMMEDIATE transaction makes the workers claim one after the other.
+    """
+    now = datetime.now(UTC)
+    expires = now + timedelta(seconds=settings.LEASE_TTL)
+    with transaction.atomic():
+        due_chats = get_due_chats(today, timezone, send_hour).filter(is_lease_free(now))
+        pks = list(due_chats.select_for_update(skip_locked=True).order_by('pk')
+                   .values_list('pk', flat=True)[:settings.SEND_CHUNK_SIZE])
+        Chat.objects.filter(pk__in=pks).update(lease_owner=settings.WORKER_ID, lease_expires=expires)
+    return list(Chat.objects.filter(pk__in=pks).order_by('pk').only(*Chat.SEND_FIELDS, *Chat.LEASE_FIELDS))
+
+
+async def claim_chat(chat, today=None) -> bool:
+    """
+    Takes the lease of a single chat, see iterate_due_chats.
+    :param today: if given, the chat is only claimed if it is due
+    """
+    now = datetime.now(UTC)
+    expires = now + timedelta(seconds=settings.LEASE_TTL)
+    lease_free = is_lease_free(now)
+    if chat.lease_owner is None:  # released by this worker but maybe not written yet
+        lease_free |= Q(lease_owner=settings.WORKER_ID)
+    chats = Chat.objects.filter(lease_free, pk=chat.pk)
+    if today:
+        chats = chats.filter(is_due(today))
+    if not await chats.aupdate(lease_owner=settings.WORKER_ID, lease_expires=expires):
+        return False
+    chat.lease_owner, chat.lease_expires = settings.WORKER_ID, expires
+    return True
+
+
+def release_chat(chat):
+    """The lease is written together with the buffered changes of the chat, like last_sent"""
+    chat.lease_owner = chat.lease_expires = None
+    chat_writes.add(chat, Chat.LEASE_FIELDS)
+
+
+async def send_due_chat(chat, plan: SendPlan) -> int:
+    try:
+        return await do_send_now(chat, plan)
+    finally:
+        release_chat(chat)
+        metrics.due_chats.dec()
+
+
+async def send_today_if_due(chat_id) -> int:
+    """Outside the send hours of the chat the lesson is left to the next send all"""
+    chat = await get_chat(chat_id)
+    today = get_chat_now(chat).date()
+    if not chat.send_lesson or not can_send_now(chat) or not await claim_chat(chat, today):
+        return 0
+    try:
+        return await do_send_now(chat, SendPlan(today, priority=Priority.RESEND))
+    finally:
+        release_chat(chat)
+
+
+async def do_send_now(chat, plan: SendPlan) -> int:
+    return await send_lesson(chat, plan.get_lesson_number(chat), language=chat.language, plan=plan)
+
+
+async def resend_lesson(chat) -> int:
+    """Sends again the lesson sent today, or sends today's lesson if it wasn't sent yet"""
+    plan = SendPlan(get_chat_now(chat).date(), priority=Priority.RESEND)
+    if not await claim_chat(chat):
+        logger.warning(f'{chat} - Not resending, the lesson is being sent')
+        return 0
+    try:
+        if chat.last_sent == plan.today and chat.last_lesson_sent is not None:
+            lesson_number = chat.last_lesson_sent
+        else:
+            lesson_number = plan.get_lesson_number(chat)
+        return await send_lesson(chat, lesson_number, language=chat.language, plan=plan, resume=False)
+    finally:
+        release_chat(chat)
 
 
 def can_send_now(chat):
-    now = datetime.now()
+    now = get_chat_now(chat)
     today = now.date()
     if not can_send_today(today, chat):
         return False
-    return 8 <= now.hour < 23
+    return is_send_hour(now, chat.send_hour)
+
+
+def is_send_hour(now, send_hour=SEND_START_HOUR):
+    return send_hour <= now.hour < SEND_END_HOUR
+
+
+def get_chat_now(chat):
+    return datetime.now(get_zone(chat.timezone))
+
+
+def get_zone(timezone):
+    """A chat with a timezone that is not valid, as set before it was validated, uses the default one"""
+    try:
+        return ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(settings.TIME_ZONE)
 
 
 def can_send_today(today, chat):
@@ -115,48 +350,162 @@ def can_send_today(today, chat):
     return (today - chat.last_sent).days >= 1
 
 
-async def send_lesson(chat, lesson_number, language=None):
-    logger.info(f'{chat} - Sending lesson {lesson_number + 1}')
-    for text in get_day_texts(lesson_number, language=language):
+@metrics.timed(metrics.function_seconds)
+async def send_lesson(chat, lesson_number, language=None, plan: SendPlan = None, resume=True) -> int:
+    """
+    Sends all the parts of a lesson, or copies them from the storage channel if there is one.
+    Parts failing with a transient error are queued for retry.
+    Parts already delivered today are skipped, so a lesson interrupted by a restart is resumed.
+    :param resume: False to send all the parts again
+    :return: the number of messages sent
+    """
+    if language is None:
+        language = settings.WORKBOOK_LANGUAGE
+    if plan is None:
+        plan = SendPlan(get_chat_now(chat).date())
+    today = plan.today
+    messages = plan.get_messages(lesson_number, language)
+    sent_parts = await deliveries.get_sent_parts(chat, today, lesson_number) if resume else set()
+    if sent_parts:
+        logger.info(f'{chat} - Resuming lesson {lesson_number + 1}, {len(sent_parts)} parts already sent')
+    else:
+        logger.info(f'{chat} - Sending lesson {lesson_number + 1}')
+    parts = [part for part in range(len(messages)) if part not in sent_parts]
+    sent = 0
+    failed = False
+    for batch in await plan.get_batches(lesson_number, language, parts):
         try:
-            await __send_lesson_text(chat.chat_id, text)
+            message_ids = await __send_lesson_parts(chat.chat_id, lesson_number, language, batch, plan.priority)
+            for part, message_id in zip(batch, message_ids):
+                deliveries.add(chat, today, lesson_number, part, message_id=message_id)
+            sent += len(batch)
         except TelegramError as e:
-            if 'blocked by the user' in str(e):
-                logger.warn(f'{chat} - Blocked by the user')
-                chat.send_lesson = False
-                await chat.asave()
-                return
-    chat.last_sent = datetime.now().date()
+            metrics.messages_failed.inc(len(batch), error=type(e).__name__)
+            if isinstance(e, ChatMigrated) and not await migrate_chat(chat, e.new_chat_id):
+                return sent
+            if reason := get_dead_chat_reason(e):
+                disable_chat(chat, reason)
+                return sent
+            elif is_retryable_error(e):
+                await retry_queue.enqueue(chat, today, lesson_number, language, [p for p in parts if p >= batch[0]], e)
+                break
+            else:
+                logger.error(f'{chat} - Error sending parts {[p + 1 for p in batch]} of lesson {lesson_number + 1}: {e}')
+                for part in batch:
+                    deliveries.add(chat, today, lesson_number, part, status=Delivery.FAILED)
+                failed = True
+    await deliveries.write(chat, today, lesson_number)  # before the lesson counts as sent
+    chat.last_sent = today
     chat.last_lesson_sent = lesson_number
-    await chat.asave()
+    fields = ['last_sent', 'last_lesson_sent']
+    if failed or chat.failures:
+        chat.failures = chat.failures + 1 if failed else 0
+        fields.append('failures')
+    chat_writes.add(chat, fields)
+    return sent
 
 
-async def __send_lesson_text(chat_id, text):
-    messages = split_for_telegram(text)
-    if len(messages) > 1:
-        part_lengths = [len(message) for message in messages]
-        logger.debug(f'Splitting message of length {len(text)} into {len(messages)} parts of lengths {part_lengths}')
+async def send_lesson_part(chat, day, lesson_number, language, part):
+    """:param day: of the lesson, recorded in its delivery so that it is resumed on that day"""
+    if part < len(get_lesson_messages(lesson_number, language)):
+        message_ids = await __send_lesson_parts(chat.chat_id, lesson_number, language, [part], Priority.BROADCAST)
+        day = day or get_chat_now(chat).date()
+        deliveries.add(chat, day, lesson_number, part, message_id=message_ids[0])
+        await deliveries.write(chat, day, lesson_number)
+
+
+@metrics.timed(metrics.function_seconds)
+async def __send_lesson_parts(chat_id, lesson_number, language, parts, priority: Priority) -> list[int]:
+    """:return: the ids of the messages sent"""
+    if lesson_storage.is_enabled():
+        stored_ids = await lesson_storage.get_message_ids(lesson_number, language)
+        if len(parts) == 1:
+            copies = [await broadcast_bot.copy_message(chat_id, settings.LESSON_STORAGE_CHANNEL, stored_ids[parts[0]],
+                                                       rate_limit_args=priority)]
+        else:
+            copies = await broadcast_bot.copy_messages(chat_id, settings.LESSON_STORAGE_CHANNEL,
+                                                       [stored_ids[part] for part in parts], rate_limit_args=priority)
+        message_ids = [copy.message_id for copy in copies]
     else:
-        logger.debug(f'Sending message of length {len(text)}')
-    for message in messages:
-        await bot.send_message(chat_id, message, parse_mode=ParseMode.MARKDOWN)
+        messages = get_lesson_messages(lesson_number, language)
+        message_ids = []
+        for part in parts:
+            logger.debug(f'Sending message of length {len(messages[part].text)}')
+            message = await broadcast_bot.send_message(chat_id, messages[part].text, entities=messages[part].entities,
+                                                       rate_limit_args=priority)
+            message_ids.append(message.message_id)
+    metrics.messages_sent.inc(len(message_ids))
+    return message_ids
 
 
+def disable_chat(chat, reason):
+    """Stops sending to a chat that can't receive messages. The changes are buffered and written in bulk."""
+    logger.warning(f'{chat} - Not sending lessons anymore: {reason}')
+    if reason == 'blocked':
+        metrics.chats_blocked.inc()
+    metrics.chats_disabled.inc(reason=reason)
+    chat.send_lesson = False
+    chat_writes.add(chat, ['send_lesson'])
 
-def split_for_telegram(text):
-    parts = []
-    lines = text.split('\n')
-    part_len = 0
-    part = []
-    for line in lines:
-        new_len = part_len + len(line) + (1 if part_len else 0)
-        if new_len <= 4096:
-            part.append(line)
-        else:
-            parts.append('\n'.join(part))
-            part = [line]
-            new_len = len(line)
-        part_len = new_len
-    if len(part) > 0:
-        parts.append('\n'.join(part))
-    return parts
+
+async def migrate_chat(chat, new_chat_id) -> bool:
+    """
+    A group upgraded to a supergroup gets a new chat_id, and the lessons continue in the supergroup.
+    :return: False if the supergroup is already another chat, then this one is disabled
+    """
+    if await Chat.objects.filter(chat_id=new_chat_id).aexists():
+        disable_chat(chat, 'migrated')
+        return False
+    logger.info(f'{chat} - Migrated to {new_chat_id}')
+    metrics.chats_migrated.inc()
+    await Chat.objects.filter(pk=chat.pk).aupdate(chat_id=new_chat_id)
+    old_chat_id, chat.chat_id = chat.chat_id, new_chat_id
+    chat_writes.rename(old_chat_id, chat)
+    chat_cache.invalidate(old_chat_id)
+    return True
+
+
+def record_failure(chat):
+    chat.failures += 1
+    chat_writes.add(chat, ['failures'])
+
+
+async def sweep_failing_chats():
+    """Stops sending to the chats whose last CHAT_MAX_FAILURES lessons failed, so they are not due anymore"""
+    failing = Chat.objects.filter(send_lesson=True, failures__gte=settings.CHAT_MAX_FAILURES)
+    chat_ids = [chat_id async for chat_id in failing.values_list('chat_id', flat=True)]
+    if not chat_ids:
+        return
+    await Chat.objects.filter(chat_id__in=chat_ids).aupdate(send_lesson=False)
+    for chat_id in chat_ids:
+        chat_cache.invalidate(chat_id)
+        buffered = chat_writes.get(chat_id)
+        if buffered:
+            buffered.send_lesson = False
+    logger.warning(f'Not sending lessons anymore to {len(chat_ids)} chats that failed {settings.CHAT_MAX_FAILURES} '
+                   f'times in a row')
+    metrics.chats_disabled.inc(len(chat_ids), reason='failures')
+
+
+DEAD_CHAT_ERRORS = {  # part of the error message -> reason
+    'blocked by the user': 'blocked',
+    'chat not found': 'not_found',
+    'bot was kicked': 'kicked',
+    'user is deactivated': 'deactivated',
+    'bot is not a member': 'not_member',
+    'group chat was deleted': 'deleted',
+}
+
+
+def get_dead_chat_reason(e: TelegramError) -> str | None:
+    """:return: why the chat can't receive messages anymore, or None if the error is about the message"""
+    message = str(e).lower()
+    for error, reason in DEAD_CHAT_ERRORS.items():
+        if error in message:
+            return reason
+    return None
+
+
+def is_retryable_error(e: TelegramError):
+    """Migrated chats are retried with the new chat_id"""
+    return isinstance(e, (RetryAfter, ChatMigrated)) or (isinstance(e, NetworkError) and not isinstance(e, BadRequest))
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from . import bot as bot_module, bot_updates
+from .chat_cache import chat_cache
+from .dispatcher import dispatch
+from .models import BotJob, Chat
+from .write_buffer import chat_writes
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+
+
+async def refresh_name(chat):
+    await bot_updates.retrieve_chat_name(chat)
+
+
+async def resend_lesson(chat):
+    return await bot_module.resend_lesson(chat)
+
+
+async def set_calendar_mode(chat):
+    """Unlike bot.set_lesson_mode, keeps last_sent, so the lesson already sent today is not sent again"""
+    if not chat.is_calendar:
+        chat.is_calendar = True
+        chat.last_lesson_sent = None
+        chat_writes.add(chat, ['is_calendar', 'last_lesson_sent'])
+
+
+JOB_FUNCTIONS = {
+    BotJob.REFRESH_NAMES: refresh_name,
+    BotJob.RESEND_LESSON: resend_lesson,
+    BotJob.CALENDAR_MODE: set_calendar_mode,
+}
+
+
+def create_job(action, chat_ids) -> BotJob:
+    """
+    Called from the admin, the job is picked up by job_loop in the bot process.
+    :param chat_ids: in pk order, the order they are processed in, see iterate_chats
+    """
+    chat_ids = list(chat_ids)
+    return BotJob.objects.create(action=action, chat_ids=chat_ids, total=len(chat_ids))
+
+
+def get_lease_expires():
+    return timezone.now() + timedelta(seconds=settings.BOT_JOB_LEASE_TTL)
+
+
+async def claim_next_job() -> BotJob | None:
+    """
+    Several processes can run job_loop, each job is run by the one that claims it first.
+    A running job whose lease expired was left by a process that died, and is resumed.
+    """
+    claimable = Q(status=BotJob.PENDING) | Q(status=BotJob.RUNNING, lease_expires__lt=timezone.now())
+    async for job in BotJob.objects.filter(claimable).order_by('created'):
+        lease_expires = get_lease_expires()
+        if await BotJob.objects.filter(claimable, pk=job.pk) \
+                .aupdate(status=BotJob.RUNNING, owner=settings.WORKER_ID, lease_expires=lease_expires):
+            if job.status == BotJob.RUNNING:
+                logger.warning(f'Resuming job {job.pk} left by {job.owner}')
+            job.status, job.owner, job.lease_expires = BotJob.RUNNING, settings.WORKER_ID, lease_expires
+            return job
+    return None
+
+
+async def iterate_chats(chat_ids, after_pk=0):
+    """The chats in pk order, as chat_ids is, starting after the chat with after_pk"""
+    for i in range(0, len(chat_ids), CHUNK_SIZE):
+        chats = Chat.objects.filter(chat_id__in=chat_ids[i:i + CHUNK_SIZE], pk__gt=after_pk).order_by('pk')
+        async for chat in chats:
+            buffered = chat_writes.get(chat.chat_id)  # might have changes not written yet
+            if buffered:
+                chat = buffered
+            else:
+                chat_cache.refresh(chat)
+            yield chat
+
+
+async def run_job(job: BotJob):
+    """Runs the action on the chats concurrently, through the bot's rate limiter, saving the progress periodically"""
+    logger.info(f'Running job {job.pk} - {job}')
+    job_function = JOB_FUNCTIONS[job.action]
+    started = deque()  # pks of the chats started after the cursor, in order
+    finished = set()
+
+    async def iterate():
+        async for chat in iterate_chats(job.chat_ids, job.cursor):  # after the ones of a process that died
+            started.append(chat.pk)
+            yield chat
+
+    async def run_chat(chat):
+        try:
+            sent = await job_function(chat)
+            job.done += 1
+            return sent
+        except Exception:
+            job.failed += 1
+            raise
+        finally:
+            finished.add(chat.pk)
+            while started and started[0] in finished:
+                job.cursor = started.popleft()
+                finished.discard(job.cursor)
+
+    async def save_progress():
+        """Chats processed after the last save are processed again if the job is resumed"""
+        while True:
+            await asyncio.sleep(settings.BOT_JOB_PROGRESS_INTERVAL)
+            if not await BotJob.objects.filter(pk=job.pk, owner=settings.WORKER_ID) \
+                    .aupdate(done=job.done, failed=job.failed, cursor=job.cursor, lease_expires=get_lease_expires()):
+                logger.warning(f'Job {job.pk} was resumed by another process')
+
+    progress_task = asyncio.create_task(save_progress())
+    try:
+        stats = await dispatch(iterate(), run_chat, concurrency=settings.BOT_JOB_CONCURRENCY)
+    finally:
+        progress_task.cancel()
+    job.total = job.done + job.failed  # chats deleted since the job was created are not counted
+    job.status = BotJob.DONE
+    job.finished = timezone.now()
+    await job.asave(update_fields=['done', 'failed', 'cursor', 'total', 'status', 'finished'])
+    logger.info(f'Job {job.pk} finished - {stats}')
+
+
+async def job_loop():
+    logger.info('Starting job loop')
+    while True:
+        try:
+            while job := await claim_next_job():
+                await run_job(job)
+        except Exception as e:
+            logger.exception(e)
+        await asyncio.sleep(settings.BOT_JOB_POLL_INTERVAL)
@@ -1,24 +1,99 @@
 import logging
 import asyncio
-from lessons.bot_updates import initialize_bot
-from lessons.bot import try_send_all
+import signal
+from django.conf import settings
+from lessons import metrics
+from lessons.workbook import compile_workbook
+from lessons.bot_updates import initialize_bot, shutdown_bot
+from lessons.scheduler import lesson_scheduler
+from lessons.retry_queue import retry_loop
+from lessons.bot_jobs import job_loop
+from lessons.write_buffer import chat_writes
+from lessons.deliveries import deliveries
+from lessons.startup import startup_timer
 
 logger = logging.getLogger(__name__)
 
 
-async def run_bot_loop():
+background_task = None
+
+
+async def run_bot_loop(worker=False):
+    """
+    Runs the bot with long polling, see start_webhook_bot for webhook mode.
+    :param worker: only send lessons, without receiving updates. Any number of workers can run
+                   along the single polling process, each one claiming different due chats.
+    """
+    cancel_on_sigterm()
+    try:
+        await start_bot(webhook=False, worker=worker)
+        loops = [run_send_loops(worker=worker)]
+        if settings.METRICS_DIR:
+            loops.append(metrics.snapshot_loop(settings.METRICS_DIR, settings.WORKER_ID, settings.METRICS_INTERVAL))
+        await asyncio.gather(*loops)
+    finally:
+        # after the send loops wrote the pending chat changes, stopping the application writes the conversation states
+        await shutdown_bot()
+
+
+async def start_bot(webhook, worker=False):
+    compile_workbook(cache_file=settings.WORKBOOK_CACHE_FILE)
+    startup_timer.phase('workbook')
     application = await initialize_bot()
-    await application.updater.start_polling()
+    startup_timer.phase('bot')
+    if worker:
+        logger.info(f'Starting worker {settings.WORKER_ID}')
+    elif webhook:
+        logger.info(f'Setting webhook {get_webhook_url()}')
+        await application.bot.set_webhook(get_webhook_url(), secret_token=settings.TELEGRAM_SECRET_TOKEN)
+    else:
+        await application.updater.start_polling()
     await application.start()
-    await send_all_loop()
+    startup_timer.phase('updates')
+    startup_timer.report()
+    return application
+
+
+async def run_send_loops(worker=False):
+    if not settings.SEND_LESSONS and not worker:
+        logger.info('Not sending lessons in this process')
+        return await asyncio.Event().wait()
+    try:
+        await asyncio.gather(lesson_scheduler.run(), retry_loop(), job_loop(),
+                             chat_writes.flush_loop(), deliveries.flush_loop())
+    finally:
+        logger.info('Stopping, writing pending chat changes')
+        await deliveries.flush()
+        await chat_writes.flush()
+
 
+async def start_webhook_bot():
+    """
+    Starts the bot in the event loop of the ASGI server. Updates are received by views.telegram_webhook.
+    The conversations are kept in the process, so the ASGI server must run a single worker.
+    """
+    global background_task
+    await start_bot(webhook=True)
+    background_task = asyncio.create_task(run_send_loops())
 
-async def send_all_loop():
-    DELAY = 5 * 60
-    logger.info(f'Starting send_all loop with delay {DELAY / 60} minutes')
-    while True:
+
+async def stop_webhook_bot():
+    if background_task:
+        background_task.cancel()
         try:
-            await try_send_all()
-        except Exception as e:
-            logger.exception(e)
-        await asyncio.sleep(DELAY)
+            await background_task
+        except asyncio.CancelledError:
+            pass
+    await shutdown_bot()
+
+
+def get_webhook_url():
+    from django.urls import reverse  # imports most of django.http, only needed in webhook mode
+    return f'{settings.TELEGRAM_WEBHOOKS_SERVER}{reverse("telegram_webhook")}'
+
+
+def cancel_on_sigterm():
+    """So that a service restart runs the cleanup of the main task instead of killing the process"""
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+
@@ -1,16 +1,24 @@
+import asyncio
 import logging
 from enum import Enum
 from django.conf import settings
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.constants import ChatMemberStatus, ParseMode, ChatType
 from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, ChatMemberHandler, \
-    MessageHandler, filters
+    MessageHandler, ExtBot, filters
 from telegram.error import BadRequest
-from . import bot as bot_module
+from . import bot as bot_module, metrics
+from .rate_limit import TelegramRateLimiter, Priority
+from .persistence import DatabasePersistence
+from .telegram_request import build_request
+from .update_processor import ChatOrderedUpdateProcessor, UpdateQueue
+from .write_buffer import chat_writes
 
 
 logger = logging.getLogger(__name__)
 
+set_commands_task = None
+
 
 class State(Enum):
     LESSON_MODE, LESSON_NUMBER, LESSON_LANGUAGE = range(1, 4)
@@ -28,17 +36,45 @@ class LessonLanguage(Enum):
 
 
 async def initialize_bot():
+    """
+    The application bot answers the updates, while lessons are sent by broadcast_bot with its own connection pool,
+    so a broadcast doesn't make the replies wait for a connection. Both share the rate limiter.
+    The commands menu is set in the background, as it is not needed to answer the updates.
+    """
+    global set_commands_task
     if not bot_module.bot:
         logger.info('Initializing bot')
-        bot_module.application = Application.builder().token(settings.TELEGRAM_TOKEN).build()
+        rate_limiter = TelegramRateLimiter()
+        bot_module.application = Application.builder().token(settings.TELEGRAM_TOKEN) \
+            .base_url(settings.TELEGRAM_BASE_URL).rate_limiter(rate_limiter) \
+            .request(build_request('updates', settings.TELEGRAM_POOL_SIZE)) \
+            .update_queue(UpdateQueue(settings.UPDATE_MAX_PENDING)) \
+            .persistence(DatabasePersistence()).concurrent_updates(ChatOrderedUpdateProcessor()).build()
         configure_handlers(bot_module.application)
-        await bot_module.application.initialize()
+        bot_module.broadcast_bot = ExtBot(settings.TELEGRAM_TOKEN, base_url=settings.TELEGRAM_BASE_URL,
+                                          request=build_request('broadcast', settings.TELEGRAM_BROADCAST_POOL_SIZE),
+                                          rate_limiter=rate_limiter)
+        await asyncio.gather(bot_module.application.initialize(), bot_module.broadcast_bot.initialize())
         bot_module.bot = bot_module.application.bot
         logger.info(f'Bot: {bot_module.bot.username}')
-        await bot_module.set_commands()
+        set_commands_task = asyncio.create_task(bot_module.set_commands())
     return bot_module.application
 
 
+async def shutdown_bot():
+    application = bot_module.application
+    if set_commands_task and not set_commands_task.done():
+        set_commands_task.cancel()
+    if application:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await bot_module.broadcast_bot.shutdown()
+    bot_module.bot = bot_module.broadcast_bot = bot_module.application = None
+
+
 def enum_regex(enum_type):
     regex = '|'.join([e.value for e in enum_type])
     return f'^({regex})$'
@@ -50,12 +86,14 @@ def configure_handlers(application: Application):
         states={
             State.LESSON_MODE: [MessageHandler(filters.Regex(enum_regex(LessonType)), lesson_set_mode_state)],
             State.LESSON_NUMBER: [MessageHandler(filters.TEXT, lesson_number_state)]},
-        fallbacks=[CommandHandler('cancel', cancel_state)], conversation_timeout=10 * 60, allow_reentry=True
+        fallbacks=[CommandHandler('cancel', cancel_state)], conversation_timeout=settings.CONVERSATION_TIMEOUT,
+        allow_reentry=True, name='start', persistent=True
     )
     language_handler = ConversationHandler(
         entry_points=[CommandHandler('idioma', language_state)],
         states={State.LESSON_LANGUAGE: [MessageHandler(filters.Regex(enum_regex(LessonLanguage)), language_set_state)]},
-        fallbacks=[CommandHandler('cancel', cancel_state)], conversation_timeout=10 * 60, allow_reentry=True
+        fallbacks=[CommandHandler('cancel', cancel_state)], conversation_timeout=settings.CONVERSATION_TIMEOUT,
+        allow_reentry=True, name='language', persistent=True
     )
     member_handler = ChatMemberHandler(process_chat_member)
     stop_handler = ConversationHandler(entry_points=[CommandHandler('stop', stop_state)], states={}, fallbacks=[])
@@ -76,6 +114,10 @@ def configure_handlers(application: Application):
     application.add_handler(calendar_handler)
     application.add_handler(lesson_number_handler)
 
+    send_time_handler = ConversationHandler(entry_points=[CommandHandler('hora', send_time_state)],
+                                            states={}, fallbacks=[])
+    application.add_handler(send_time_handler)
+
     for language in [LessonLanguage.EN, LessonLanguage.ES]:
         language_handler = ConversationHandler(
             entry_points=[CommandHandler(language.name.lower(), change_language_state_fn(language))],
@@ -84,6 +126,7 @@ def configure_handlers(application: Application):
         application.add_handler(language_handler)
 
 
+@metrics.timed(metrics.function_seconds)
 async def start_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - start_state')
@@ -99,6 +142,7 @@ async def start_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     return State.LESSON_MODE
 
 
+@metrics.timed(metrics.function_seconds)
 async def stop_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - stop_state')
@@ -113,6 +157,7 @@ def get_reply_markup(options, placeholder=None):
     return ReplyKeyboardMarkup([options], one_time_keyboard=True, input_field_placeholder=placeholder)
 
 
+@metrics.timed(metrics.function_seconds)
 async def language_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     reply_markup = get_reply_markup([LessonLanguage.ES.value, LessonLanguage.EN.value], placeholder='¿Lenguaje?')
     chat = await get_or_create_chat(update)
@@ -126,6 +171,7 @@ async def language_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     return State.LESSON_LANGUAGE
 
 
+@metrics.timed(metrics.function_seconds)
 async def language_set_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     language = LessonLanguage(update.message.text)
@@ -146,6 +192,7 @@ async def already_set_language_message(update, language):
 
 
 def change_language_state_fn(language: LessonLanguage):
+    @metrics.timed(metrics.function_seconds)
     async def change_language_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
         chat = await get_or_create_chat(update)
         lang_code = language.name.lower()
@@ -158,6 +205,7 @@ def change_language_state_fn(language: LessonLanguage):
     return change_language_state
 
 
+@metrics.timed(metrics.function_seconds)
 async def calendar_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - calendar_state')
@@ -165,6 +213,7 @@ async def calendar_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@metrics.timed(metrics.function_seconds)
 async def lesson_mode_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - lesson_mode_state')
@@ -177,6 +226,7 @@ async def lesson_mode_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int
     return State.LESSON_MODE
 
 
+@metrics.timed(metrics.function_seconds)
 async def lesson_set_mode_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     lesson_type = LessonType(update.message.text)
@@ -196,6 +246,7 @@ async def lesson_set_mode_state(update: Update, _: ContextTypes.DEFAULT_TYPE) ->
         return State.LESSON_NUMBER
 
 
+@metrics.timed(metrics.function_seconds)
 async def lesson_number_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     message_text = update.message.text.strip()
@@ -213,6 +264,7 @@ async def lesson_number_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> i
     return ConversationHandler.END
 
 
+@metrics.timed(metrics.function_seconds)
 async def lesson_number_shortcut_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - lesson_number_shortcut_state - {context.args}')
@@ -227,6 +279,32 @@ async def lesson_number_shortcut_state(update: Update, context: ContextTypes.DEF
     return ConversationHandler.END
 
 
+@metrics.timed(metrics.function_seconds)
+async def send_time_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat = await get_or_create_chat(update)
+    logger.info(f'{chat} - send_time_state - {context.args}')
+    try:
+        send_hour = int(context.args[0].strip()) if 1 <= len(context.args) <= 2 else None
+    except ValueError:
+        send_hour = None
+    timezone = context.args[1].strip() if send_hour is not None and len(context.args) == 2 else None
+    if send_hour is None or not bot_module.SEND_HOURS_MIN <= send_hour <= bot_module.SEND_HOURS_MAX:
+        await update.message.reply_text(
+            f'Actualmente recibes las lecciones a partir de las {chat.send_hour}:00 ({chat.timezone}).\n\n'
+            f'Para cambiarlo envía /hora seguido de la hora ({bot_module.SEND_HOURS_MIN} - {bot_module.SEND_HOURS_MAX}) '
+            'y opcionalmente tu zona horaria, por ejemplo:\n\n/hora 7 Europe/Madrid')
+        return ConversationHandler.END
+    if timezone and not bot_module.is_valid_timezone(timezone):
+        await update.message.reply_text(f'No conozco la zona horaria "{timezone}". '
+                                        'Usa un nombre como America/Mexico_City o Europe/Madrid.')
+        return ConversationHandler.END
+    await bot_module.set_send_time(chat.chat_id, send_hour, timezone)
+    await update.message.reply_text(f'Recibirás las lecciones a partir de las {send_hour}:00 '
+                                    f'({timezone or chat.timezone}).')
+    return ConversationHandler.END
+
+
+@metrics.timed(metrics.function_seconds)
 async def cancel_state(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     chat = await get_or_create_chat(update)
     logger.info(f'{chat} - cancel_state')
@@ -260,9 +338,10 @@ async def update_name_from_message(chat, message):
     if name and chat.username != name:
         logger.info(f'{chat} - updating name to "{name}"')
         chat.username = name
-        await chat.asave()
+        chat_writes.add(chat, ['username'])
 
 
+@metrics.timed(metrics.function_seconds)
 async def process_chat_member(update, _: ContextTypes.DEFAULT_TYPE):
     my_chat_member = update.my_chat_member
     new_chat_member = my_chat_member and update.my_chat_member.new_chat_member
@@ -279,12 +358,12 @@ async def process_chat_member(update, _: ContextTypes.DEFAULT_TYPE):
 async def retrieve_chat_name(chat):
     logger.info(f'{chat} - retrieving chat name')
     try:
-        info = await bot_module.bot.get_chat(chat.chat_id)
+        info = await bot_module.broadcast_bot.get_chat(chat.chat_id, rate_limit_args=Priority.BROADCAST)
     except BadRequest:
         logger.error(f'{chat} - Bad request when retrieving chat name')
         return
     username = getattr(info, 'title') or getattr(info, 'username')
     if username and username != chat.username:
-        print(f'{chat} - Updating username to "{username}"')
+        logger.info(f'{chat} - Updating username to "{username}"')
         chat.username = username
-        await chat.asave()
+        chat_writes.add(chat, ['username'])
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+from . import metrics
+
+
+class ChatCache:
+    """
+    LRU cache of Chat instances by chat_id. Changes are made on the cached instance and then saved,
+    so the cache is always up to date within the process. Entries expire after CHAT_CACHE_TTL seconds
+    to pick up changes made by other processes, like the admin or the workers sending lessons, which
+    can be that old. The fields the handlers branch on are re-read before using them, see bot.refresh_chat_fields.
+    """
+    def __init__(self):
+        self.chats = OrderedDict()  # chat_id -> (chat, expires)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id):
+        entry = self.chats.get(chat_id)
+        if entry and entry[1] > time.monotonic():
+            self.chats.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+        if entry:
+            del self.chats[chat_id]
+        self.misses += 1
+        return None
+
+    def put(self, chat):
+        self.chats[chat.chat_id] = (chat, time.monotonic() + settings.CHAT_CACHE_TTL)
+        self.chats.move_to_end(chat.chat_id)
+        while len(self.chats) > settings.CHAT_CACHE_SIZE:
+            self.chats.popitem(last=False)
+
+    def refresh(self, chat):
+        """Replaces the cached instance with a newer one, without caching chats that are not already cached"""
+        if chat.chat_id in self.chats:
+            self.put(chat)
+
+    def invalidate(self, chat_id):
+        self.chats.pop(chat_id, None)
+
+    def clear(self):
+        self.chats.clear()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def __str__(self):
+        return f'{len(self.chats)} chats, {self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%})'
+
+
+chat_cache = ChatCache()
+
+metrics.Gauge('ucdm_chat_cache_chats', 'Chats in the cache', function=lambda: len(chat_cache.chats))
+metrics.Counter('ucdm_chat_cache_hits_total', 'Chat cache hits', function=lambda: chat_cache.hits)
+metrics.Counter('ucdm_chat_cache_misses_total', 'Chat cache misses', function=lambda: chat_cache.misses)
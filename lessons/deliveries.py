@@ -0,0 +1,128 @@
+import time
+import asyncio
+import logging
+from datetime import date, timedelta
+from django.conf import settings
+
+from .models import Delivery
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+PRUNE_INTERVAL = 60 * 60  # seconds
+
+
+class DeliveryLog:
+    """
+    Records the lesson parts sent to each chat with batched inserts. A lesson only counts as sent after write()
+    returns, which waits for a flush shared with the chats sent at the same time, so a crash doesn't lose the
+    parts of lessons already sent. The sent parts of a whole chunk of chats are read with a single query by preload().
+    """
+    def __init__(self):
+        self.pending = {}  # (chat pk, date, lesson_number) -> {part: Delivery}
+        self.flushing = {}  # deliveries being written
+        self.preloaded = {}  # (chat pk, date) -> {(lesson_number, part)} sent, oldest first
+        self.written = None  # future resolved by the next flush, awaited by write()
+        self.lock = asyncio.Lock()
+        self.next_prune = 0
+
+    def add(self, chat, day: date, lesson_number, part, status=Delivery.SENT, message_id=None):
+        delivery = Delivery(chat=chat, date=day, lesson_number=lesson_number, part=part,
+                            status=status, message_id=message_id)
+        self.pending.setdefault((chat.pk, day, lesson_number), {})[part] = delivery
+        if self.count() >= settings.WRITE_BUFFER_SIZE and not self.lock.locked():
+            asyncio.create_task(self.flush())
+
+    async def write(self, chat, day: date, lesson_number):
+        """
+        Waits until the parts of the lesson added for the chat are written, by a flush DELIVERY_WRITE_DELAY later
+        or earlier when the buffer is full. A failed write is logged and retried by the next flush.
+        """
+        key = (chat.pk, day, lesson_number)
+        if key not in self.pending and key not in self.flushing:
+            return
+        if self.written is None:
+            self.written = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self.flush(delay=settings.DELIVERY_WRITE_DELAY))
+        await asyncio.shield(self.written)
+
+    def count(self):
+        return sum(len(parts) for parts in self.pending.values())
+
+    async def preload(self, chats, day: date):
+        """Reads the sent parts of many chats at once, used by the next get_sent_parts of each chat"""
+        sent = {(chat.pk, day): set() for chat in chats}
+        deliveries = Delivery.objects.filter(chat_id__in=[chat.pk for chat in chats], date=day, status=Delivery.SENT)
+        async for chat_pk, lesson_number, part in deliveries.values_list('chat_id', 'lesson_number', 'part'):
+            sent[(chat_pk, day)].add((lesson_number, part))
+        self.preloaded.update(sent)
+        while len(self.preloaded) > 2 * settings.SEND_CHUNK_SIZE:  # left by chats not sent, keeps two chunks
+            del self.preloaded[next(iter(self.preloaded))]
+
+    def discard_preloaded(self, chat, day: date):
+        self.preloaded.pop((chat.pk, day), None)
+
+    async def get_sent_parts(self, chat, day: date, lesson_number) -> set[int]:
+        sent = self.preloaded.pop((chat.pk, day), None)
+        if sent is None:
+            deliveries = Delivery.objects.filter(chat=chat, date=day, lesson_number=lesson_number, status=Delivery.SENT)
+            sent = {(lesson_number, part) async for part in deliveries.values_list('part', flat=True)}
+        parts = {part for lesson, part in sent if lesson == lesson_number}
+        for buffer in [self.pending, self.flushing]:
+            buffered = buffer.get((chat.pk, day, lesson_number), {})
+            parts |= {part for part, delivery in buffered.items() if delivery.status == Delivery.SENT}
+        return parts
+
+    async def flush(self, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        async with self.lock:
+            written, self.written = self.written, None
+            try:
+                await self.write_pending()
+            finally:
+                if written and not written.done():
+                    written.set_result(None)
+
+    async def write_pending(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.flushing = pending
+        deliveries = [delivery for parts in pending.values() for delivery in parts.values()]
+        written = False
+        try:
+            await Delivery.objects.abulk_create(
+                deliveries, batch_size=settings.WRITE_BUFFER_SIZE, update_conflicts=True,
+                unique_fields=['chat', 'date', 'lesson_number', 'part'], update_fields=['status', 'message_id'])
+            written = True
+            logger.debug(f'Wrote {len(deliveries)} deliveries')
+        except Exception as e:
+            logger.exception(f'Error writing {len(deliveries)} deliveries: {e}')
+        finally:
+            self.flushing = {}
+            if not written:
+                for key, parts in pending.items():  # keep the newest values if added again while flushing
+                    self.pending[key] = {**parts, **self.pending.get(key, {})}
+
+    async def prune(self):
+        oldest = date.today() - timedelta(days=settings.DELIVERY_RETENTION_DAYS)
+        deleted, _ = await Delivery.objects.filter(date__lt=oldest).adelete()
+        if deleted:
+            logger.info(f'Deleted {deleted} deliveries before {oldest}')
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.WRITE_BUFFER_INTERVAL)
+            await self.flush()
+            if time.monotonic() >= self.next_prune:
+                self.next_prune = time.monotonic() + PRUNE_INTERVAL
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logger.exception(e)
+
+
+deliveries = DeliveryLog()
+
+metrics.Gauge('ucdm_delivery_log_pending', 'Sent lesson parts waiting to be written', function=deliveries.count)
@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchStats:
+    def __init__(self):
+        self.chats = 0
+        self.messages = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def messages_per_second(self):
+        return self.messages / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return (f'{self.chats} chats, {self.messages} messages, {self.failed} failed '
+                f'in {self.elapsed:.1f}s ({self.messages_per_second:.1f} msg/s)')
+
+
+async def iterate(chats):
+    if hasattr(chats, '__aiter__'):
+        async for chat in chats:
+            yield chat
+    else:
+        for chat in chats:
+            yield chat
+
+
+async def dispatch(chats, send_fn, concurrency=None) -> DispatchStats:
+    """
+    Runs send_fn for every chat, with at most `concurrency` chats in flight.
+    Each chat is handled by a single task, so the parts of a lesson to the same chat are kept in order.
+    Rate limiting is done by the bot's rate limiter, this only bounds the number of pending sends.
+
+    :param chats: iterable or async iterable of chats
+    :param send_fn: async function that sends to a chat and returns the number of messages sent
+    """
+    stats = DispatchStats()
+    semaphore = asyncio.Semaphore(concurrency or settings.BROADCAST_CONCURRENCY)
+    tasks = set()
+
+    async def run(chat):
+        try:
+            sent = await send_fn(chat)
+            stats.messages += sent or 0
+        except Exception as e:
+            stats.failed += 1
+            logger.exception(f'{chat} - error sending: {e}')
+        finally:
+            semaphore.release()
+
+    try:
+        async for chat in iterate(chats):
+            await semaphore.acquire()
+            stats.chats += 1
+            task = asyncio.create_task(run(chat))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    except asyncio.CancelledError:  # stopping, the sends in flight finish before the changes are flushed
+        await cancel_tasks(tasks)
+        raise
+    stats.finished = time.monotonic()
+    return stats
+
+
+async def cancel_tasks(tasks):
+    """Cancels the tasks and waits for them to finish"""
+    tasks = list(tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,128 @@
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'UCDM', 'username': 'fake_ucdm_bot'}
+
+
+class FakeTelegramServer:
+    """
+    Local stand-in for the Telegram Bot API, for benchmarks.
+    Point the bot to it with base_url. Answers every method, and sendMessage, copyMessage and copyMessages
+    with configurable latency, flood control errors (429 with retry_after) and chats that blocked the bot (403).
+    For tests, chats can also be blocked or migrated to a supergroup one by one with `blocked` and `migrated`.
+
+    :param latency: seconds added to every request
+    :param retry_after_rate: fraction of sending requests answered with a 429
+    :param blocked_rate: fraction of private chats that blocked the bot
+    """
+    def __init__(self, latency=0.0, retry_after_rate=0.0, blocked_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.blocked_rate = blocked_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.blocked = set()  # chat_ids that blocked the bot
+        self.migrated = {}  # chat_id -> supergroup chat_id
+        self.lock = threading.Lock()
+        self.requests = Counter()  # method -> count
+        self.errors = Counter()  # error code -> count
+        self.sent = Counter()  # chat_id -> messages delivered
+        self.bytes_received = 0  # size of the request bodies
+        self.message_id = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                with fake.lock:
+                    fake.bytes_received += length
+                params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+                status, body = fake.handle(self.path.rsplit('/', 1)[-1], params)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def is_blocked(self, chat_id):
+        return chat_id in self.blocked or (chat_id > 0 and random.Random(chat_id).random() < self.blocked_rate)
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests[method] += 1
+            if method == 'getMe':
+                return 200, {'ok': True, 'result': BOT_USER}
+            if method == 'getUpdates':
+                return 200, {'ok': True, 'result': []}  # updates are fed to the application directly
+            if method in ('sendMessage', 'copyMessage', 'copyMessages'):
+                return self.handle_send(method, params)
+            return 200, {'ok': True, 'result': True}
+
+    def handle_send(self, method, params):
+        chat_id = int(params['chat_id'])
+        if chat_id in self.migrated:
+            self.errors[400] += 1
+            return 400, {'ok': False, 'error_code': 400,
+                         'description': 'Bad Request: group chat was upgraded to a supergroup chat',
+                         'parameters': {'migrate_to_chat_id': self.migrated[chat_id]}}
+        if self.is_blocked(chat_id):
+            self.errors[403] += 1
+            return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        if self.retry_after_rate and self.random.random() < self.retry_after_rate:
+            self.errors[429] += 1
+            return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+        if method == 'copyMessage':
+            self.sent[chat_id] += 1
+            return 200, {'ok': True, 'result': {'message_id': self.next_message_id()}}
+        if method == 'copyMessages':
+            message_ids = json.loads(params['message_ids'])
+            self.sent[chat_id] += len(message_ids)
+            return 200, {'ok': True, 'result': [{'message_id': self.next_message_id()} for _ in message_ids]}
+        chat = {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'}
+        self.sent[chat_id] += 1
+        message = {'message_id': self.next_message_id(), 'date': int(time.time()), 'chat': chat,
+                   'from': BOT_USER, 'text': params.get('text', '')}
+        return 200, {'ok': True, 'result': message}
+
+    def next_message_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    @property
+    def messages_sent(self):
+        return sum(self.sent.values())
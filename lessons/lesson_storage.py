@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import logging
+from collections import defaultdict
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import bot as bot_module
+from .markdown import LessonMessage
+from .models import StoredLesson
+from .rate_limit import Priority
+from .workbook import get_lesson_messages
+
+logger = logging.getLogger(__name__)
+
+stored_lessons = {}  # (lesson_number, language) -> message ids of the parts in the storage channel
+locks = defaultdict(asyncio.Lock)
+
+
+def is_enabled():
+    """
+    With a storage channel, each lesson is posted once to the channel and copied to the chats from there,
+    so the text is not uploaded for every chat and there is a single message to edit.
+    """
+    return bool(settings.LESSON_STORAGE_CHANNEL)
+
+
+async def get_message_ids(lesson_number, language) -> tuple[int, ...]:
+    key = (lesson_number, language)
+    if key not in stored_lessons:
+        async with locks[key]:
+            if key not in stored_lessons:
+                stored_lessons[key] = await store_lesson(lesson_number, language)
+    return stored_lessons[key]
+
+
+async def store_lesson(lesson_number, language) -> tuple[int, ...]:
+    """Posts the parts of the lesson that are not in the channel yet, and edits the ones that changed in the workbook"""
+    channel_id = settings.LESSON_STORAGE_CHANNEL
+    stored_parts = StoredLesson.objects.filter(channel_id=channel_id, lesson_number=lesson_number, language=language)
+    stored = {stored_lesson.part: stored_lesson async for stored_lesson in stored_parts}
+    message_ids = []
+    for part, message in enumerate(get_lesson_messages(lesson_number, language)):
+        text_hash = get_text_hash(message)
+        stored_lesson = stored.get(part)
+        if stored_lesson is None:
+            stored_lesson = await post_part(channel_id, lesson_number, language, part, message, text_hash)
+        elif stored_lesson.text_hash != text_hash:
+            logger.info(f'Editing stored {stored_lesson}')
+            await bot_module.broadcast_bot.edit_message_text(message.text, chat_id=channel_id,
+                                                             message_id=stored_lesson.message_id,
+                                                             entities=message.entities,
+                                                             rate_limit_args=Priority.BROADCAST)
+            stored_lesson.text_hash = text_hash
+            await stored_lesson.asave(update_fields=['text_hash'])
+        message_ids.append(stored_lesson.message_id)
+    return tuple(message_ids)
+
+
+async def post_part(channel_id, lesson_number, language, part, message: LessonMessage, text_hash):
+    posted = await bot_module.broadcast_bot.send_message(channel_id, message.text, entities=message.entities,
+                                                         rate_limit_args=Priority.BROADCAST)
+    try:
+        stored_lesson = await StoredLesson.objects.acreate(channel_id=channel_id, lesson_number=lesson_number,
+                                                           language=language, part=part,
+                                                           message_id=posted.message_id, text_hash=text_hash)
+    except IntegrityError:  # posted at the same time by another worker, keep theirs
+        await bot_module.broadcast_bot.delete_message(channel_id, posted.message_id, rate_limit_args=Priority.BROADCAST)
+        return await StoredLesson.objects.aget(channel_id=channel_id, lesson_number=lesson_number,
+                                               language=language, part=part)
+    logger.info(f'Stored {stored_lesson}')
+    return stored_lesson
+
+
+def get_text_hash(message: LessonMessage):
+    entities = [entity.to_dict() for entity in message.entities]
+    return hashlib.sha256(repr((message.text, entities)).encode()).hexdigest()
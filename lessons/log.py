@@ -0,0 +1,64 @@
+import time
+import atexit
+import logging
+from logging.handlers import QueueHandler
+from django.utils.log import AdminEmailHandler
+
+QUEUE_HANDLER = 'queue'
+
+listener_started = False
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Queues the records as they are, since the queue is in the same process they don't need to be made picklable.
+    This keeps exc_info, so the error emails have a proper subject and traceback.
+    """
+    def prepare(self, record):
+        return record
+
+
+class ThrottledAdminEmailHandler(AdminEmailHandler):
+    """
+    Mails each error at most once per interval, identified by where it was logged,
+    and no more than max_emails in total per interval, so an error repeated for every chat doesn't flood the inbox.
+    """
+    def __init__(self, interval=10 * 60, max_emails=10, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = interval
+        self.max_emails = max_emails
+        self.last_sent = {}  # (logger, path, line) -> time
+        self.window_start = 0
+        self.window_count = 0
+
+    def emit(self, record):
+        if self.should_send(record):
+            super().emit(record)
+
+    def should_send(self, record):
+        now = time.monotonic()
+        key = (record.name, record.pathname, record.lineno)
+        if now - self.last_sent.get(key, -self.interval) < self.interval:
+            return False
+        if now - self.window_start >= self.interval:
+            self.window_start, self.window_count = now, 0
+        if self.window_count >= self.max_emails:
+            return False
+        self.window_count += 1
+        self.last_sent[key] = now
+        return True
+
+
+def start_log_listener():
+    """
+    Log records are put in a queue by the QueueHandler of settings.LOGGING and written to the files and mailed
+    by its listener thread, so the event loop never waits on disk or SMTP. dictConfig creates the listener
+    but doesn't start it.
+    """
+    global listener_started
+    handler = logging.getHandlerByName(QUEUE_HANDLER)
+    listener = getattr(handler, 'listener', None)
+    if listener and not listener_started:
+        listener.start()
+        atexit.register(listener.stop)  # writes the records still in the queue
+        listener_started = True
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import asyncio
+import statistics
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from telegram import Update
+
+from lessons import bot as bot_module, workbook
+from lessons.bot_updates import initialize_bot, shutdown_bot
+from lessons.fake_telegram import FakeTelegramServer
+from lessons.markdown import compile_texts
+from lessons.models import Chat, PendingMessage
+from lessons.write_buffer import chat_writes
+from lessons.deliveries import deliveries
+
+STORAGE_CHANNEL = -1000000000001
+
+CONVERSATIONS = [
+    ['/start', 'Calendario'],
+    ['/modo', 'Otra', '42'],
+    ['/idioma', 'English'],
+    ['/hora 7 Europe/Madrid'],
+    ['/stop'],
+]
+
+
+class QueryCounter:
+    """Counts the queries of every database connection, including the ones of the async ORM threads"""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection_created.connect(self.connection_created, weak=False)
+        connection.execute_wrappers.append(self)
+
+    def connection_created(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the broadcast and the update handlers against a fake Telegram server, on a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=1000, help='number of subscribed chats')
+        parser.add_argument('--groups', type=float, default=0.1, help='fraction of the chats that are groups')
+        parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every API request')
+        parser.add_argument('--retry-after-rate', type=float, default=0, help='fraction of sends answered with a 429')
+        parser.add_argument('--blocked-rate', type=float, default=0, help='fraction of chats that blocked the bot')
+        parser.add_argument('--rate-limit', type=float, help='global messages per second, defaults to the setting')
+        parser.add_argument('--concurrency', type=int, help='chats sent at the same time, defaults to the setting')
+        parser.add_argument('--conversations', type=int, default=20, help='chats running each conversation')
+        parser.add_argument('--synthetic', action='store_true', help='use generated lessons instead of the workbook')
+        parser.add_argument('--parts', type=int, default=3, help='messages per generated lesson')
+        parser.add_argument('--storage-channel', action='store_true', help='copy the lessons from a storage channel')
+        parser.add_argument('--json', action='store_true', help='print the results as json')
+
+    def handle(self, *args, **options):
+        fake = FakeTelegramServer(latency=options['latency'], retry_after_rate=options['retry_after_rate'],
+                                  blocked_rate=options['blocked_rate']).start()
+        overrides = {'TELEGRAM_TOKEN': '123456:BENCHMARK', 'TELEGRAM_BASE_URL': fake.base_url}
+        if options['rate_limit']:
+            overrides['TELEGRAM_RATE_LIMIT'] = options['rate_limit']
+        if options['concurrency']:
+            overrides['BROADCAST_CONCURRENCY'] = options['concurrency']
+        overrides['LESSON_STORAGE_CHANNEL'] = STORAGE_CHANNEL if options['storage_channel'] else None
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        queries = QueryCounter()
+        queries.install()
+        try:
+            with override_settings(**overrides):
+                results = asyncio.run(run_benchmark(fake, queries, options))
+        finally:
+            fake.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            for section, values in results.items():
+                self.stdout.write(self.style.MIGRATE_HEADING(section))
+                for name, value in values.items():
+                    self.stdout.write(f'  {name}: {round(value, 4) if isinstance(value, float) else value}')
+
+
+async def run_benchmark(fake, queries, options):
+    if options['synthetic'] or not os.path.exists(f'{workbook.WORKBOOK_PATH}/workbook_structure.json'):
+        use_synthetic_workbook(options['parts'])
+    else:
+        workbook.compile_workbook()
+    application = await initialize_bot()
+    await application.start()  # for the job queue, updates are fed with process_update
+    try:
+        return {
+            'broadcast': await benchmark_broadcast(fake, queries, options),
+            'handlers': await benchmark_handlers(fake, application, queries, options),
+        }
+    finally:
+        await shutdown_bot()
+
+
+async def benchmark_broadcast(fake, queries, options):
+    timezone, send_hour = get_open_bucket()
+    chat_count = options['chats']
+    group_count = int(chat_count * options['groups'])
+    await Chat.objects.abulk_create([
+        Chat(chat_id=-i if i <= group_count else i, is_group=i <= group_count, send_lesson=True,
+             timezone=timezone, send_hour=send_hour)
+        for i in range(1, chat_count + 1)
+    ], batch_size=1000)
+
+    queries.count = 0
+    sent_before = fake.messages_sent
+    bytes_before = fake.bytes_received
+    start = time.monotonic()
+    await bot_module.try_send_all()
+    await deliveries.flush()
+    await chat_writes.flush()
+    elapsed = time.monotonic() - start
+    messages = fake.messages_sent - sent_before
+    return {
+        'chats': chat_count,
+        'seconds': elapsed,
+        'messages': messages,
+        'messages_per_second': messages / elapsed,
+        'queries_per_chat': queries.count / chat_count,
+        'request_bytes_per_message': (fake.bytes_received - bytes_before) / max(messages, 1),
+        'blocked': fake.errors[403],
+        'flood_control': fake.errors[429],
+        'pending_retry': await PendingMessage.objects.acount(),
+    }
+
+
+async def benchmark_handlers(fake, application, queries, options):
+    fake.blocked_rate = fake.retry_after_rate = 0  # handlers have no error handling yet
+    results = {}
+    update_id = 0
+    for n, conversation in enumerate(CONVERSATIONS):
+        latencies = []
+        queries.count = 0
+        for i in range(options['conversations']):
+            chat_id = 10 ** 7 + n * 10 ** 5 + i
+            for text in conversation:
+                update_id += 1
+                update = Update.de_json(get_message_update(update_id, chat_id, text), application.bot)
+                start = time.monotonic()
+                await application.process_update(update)
+                latencies.append(time.monotonic() - start)
+        name = conversation[0][1:].split()[0]
+        results[f'{name}_p50_ms'] = percentile(latencies, 50) * 1000
+        results[f'{name}_p95_ms'] = percentile(latencies, 95) * 1000
+        results[f'{name}_queries_per_update'] = queries.count / len(latencies)
+    await deliveries.flush()
+    await chat_writes.flush()
+    return results
+
+
+def get_message_update(update_id, chat_id, text):
+    message = {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def get_open_bucket():
+    """A timezone and send hour for which chats can be sent to right now"""
+    for timezone in ['UTC', 'Etc/GMT+2']:
+        hour = datetime.now(ZoneInfo(timezone)).hour
+        if hour < bot_module.SEND_END_HOUR:
+            return timezone, hour
+
+
+def use_synthetic_workbook(parts):
+    text = ('Nada real puede ser amenazado. Nada irreal existe. ' * 80)[:3500]
+    workbook.workbook_messages = {
+        language: tuple((compile_texts([f'*Lección {day + 1}*\n\n{text}'])[0],) * parts for day in range(365))
+        for language in ['es', 'en']
+    }
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100)[p - 1]
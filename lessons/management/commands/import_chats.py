@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import tempfile
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connections
+
+from lessons.models import Chat
+
+LEGACY = 'legacy'
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Copies the chats from a legacy SQLite database to the configured database, for moving to PostgreSQL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='the legacy db.sqlite3 file')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'legacy.sqlite3')
+            self.stdout.write(f'Copying {options["path"]} to {path}')
+            copy_sqlite(options['path'], path)
+            connections.databases[LEGACY] = {**settings.DATABASES['default'], 'ENGINE': 'django.db.backends.sqlite3',
+                                              'NAME': path, 'OPTIONS': {}}
+            try:
+                self.stdout.write('Migrating the copy so it has the same columns')
+                call_command('migrate', 'lessons', database=LEGACY, verbosity=0)
+                self.copy_chats()
+            finally:
+                connections[LEGACY].close()
+
+    def copy_chats(self):
+        copied = 0
+        last_pk = 0
+        while True:
+            chats = list(Chat.objects.using(LEGACY).filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+            if not chats:
+                break
+            for chat in chats:
+                chat.lease_owner = chat.lease_expires = None
+            fields = [field.name for field in Chat._meta.concrete_fields if not field.primary_key]
+            Chat.objects.bulk_create(chats, update_conflicts=True, unique_fields=['chat_id'],
+                                     update_fields=[field for field in fields if field != 'chat_id'])
+            copied += len(chats)
+            last_pk = chats[-1].pk
+            self.stdout.write(f'{copied} chats')
+
+        with connections['default'].cursor() as cursor:  # chats were inserted with their pk
+            for sql in connections['default'].ops.sequence_reset_sql(no_style(), [Chat]):
+                cursor.execute(sql)
+        self.stdout.write(self.style.SUCCESS(f'Copied {copied} chats'))
+
+
+def copy_sqlite(source, destination):
+    """Copies with the backup API, which includes the changes still in the WAL file and leaves the source unchanged"""
+    src = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+    dst = sqlite3.connect(destination)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
@@ -0,0 +1,172 @@
+import logging
+from typing import NamedTuple
+from telegram import MessageEntity
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_LENGTH = 4096  # in UTF-16 code units, after parsing the entities
+
+MARKERS = {'*': MessageEntity.BOLD, '_': MessageEntity.ITALIC, '`': MessageEntity.CODE}
+ESCAPABLE = '_*`['
+TEXT_SEPARATOR = '\n\n'
+
+
+class LessonMessage(NamedTuple):
+    """A message ready to send, with the formatting as entities so Telegram doesn't parse it on every send"""
+    text: str
+    entities: tuple[MessageEntity, ...] = ()
+
+
+class Span(NamedTuple):
+    """An entity while compiling, with offsets in characters instead of UTF-16 code units"""
+    type: str
+    start: int
+    end: int
+    url: str | None = None
+    language: str | None = None
+
+
+def compile_texts(texts: list[str], max_length=TELEGRAM_MAX_LENGTH) -> list[LessonMessage]:
+    """
+    Converts Telegram Markdown texts to plain text with entities, joining them and splitting them again in
+    as few messages as possible. Messages are split at line breaks and entities crossing a split are cut in two.
+    """
+    text, spans = join_texts([parse_markdown(markdown) for markdown in texts])
+    messages = []
+    for start, end in split_text(text, max_length):
+        part_spans = [span._replace(start=max(span.start, start) - start, end=min(span.end, end) - start)
+                      for span in spans if span.start < end and span.end > start]
+        messages.append(LessonMessage(text[start:end], to_entities(text[start:end], part_spans)))
+    return messages
+
+
+def parse_markdown(markdown: str) -> tuple[str, list[Span]]:
+    """
+    Parses the legacy Telegram Markdown: *bold*, _italic_, `code`, ```pre``` and [text](url), which can't be nested.
+    Markers that are not closed are kept as text, as there is no way to know what was meant.
+    """
+    text = []
+    spans = []
+    length = 0
+    i = 0
+    while i < len(markdown):
+        char = markdown[i]
+        if char == '\\' and i + 1 < len(markdown) and markdown[i + 1] in ESCAPABLE:
+            text.append(markdown[i + 1])
+            length += 1
+            i += 2
+            continue
+        span, content, end = None, None, -1
+        if markdown.startswith('```', i):
+            end = markdown.find('```', i + 3)
+            if end != -1:
+                content, language = parse_pre(markdown[i + 3:end])
+                span = Span(MessageEntity.PRE, length, length + len(content), language=language)
+                end += 3
+        elif char in MARKERS:
+            end = markdown.find(char, i + 1)
+            if end != -1:
+                content = markdown[i + 1:end]
+                span = Span(MARKERS[char], length, length + len(content))
+                end += 1
+        elif char == '[':
+            close = markdown.find('](', i + 1)
+            end = markdown.find(')', close + 2) if close != -1 else -1
+            if end != -1 and '\n' not in markdown[i:end]:
+                content = markdown[i + 1:close]
+                span = Span(MessageEntity.TEXT_LINK, length, length + len(content), url=markdown[close + 2:end])
+                end += 1
+        if span is None:
+            if char in MARKERS:
+                logger.warning(f'Unclosed {char} at {i}: {markdown[max(0, i - 20):i + 20]!r}')
+            text.append(char)
+            length += 1
+            i += 1
+            continue
+        text.append(content)
+        length += len(content)
+        if content:
+            spans.append(span)
+        i = end
+    return ''.join(text), spans
+
+
+def parse_pre(content):
+    """The first line of a pre block is its language if it has no spaces, like ```python"""
+    first_line, newline, rest = content.partition('\n')
+    if newline and first_line and ' ' not in first_line:
+        return rest, first_line
+    return content.removeprefix('\n'), None
+
+
+def join_texts(parsed: list[tuple[str, list[Span]]]) -> tuple[str, list[Span]]:
+    texts, spans = [], []
+    offset = 0
+    for text, text_spans in parsed:
+        texts.append(text)
+        spans += [span._replace(start=span.start + offset, end=span.end + offset) for span in text_spans]
+        offset += len(text) + len(TEXT_SEPARATOR)
+    return TEXT_SEPARATOR.join(texts), spans
+
+
+def split_text(text: str, max_length=TELEGRAM_MAX_LENGTH) -> list[tuple[int, int]]:
+    """
+    Splits at line breaks so every part fits in a message, lines that don't fit are split at a space.
+    Whitespace around the parts is left out, as Telegram would strip it.
+    :return: the start and end of each part
+    """
+    parts = []
+    start = end = length = 0
+    for line_start, line_end in split_long_lines(text, max_length):
+        line_length = utf16_length(text[end:line_end])  # including the line break before it
+        if length and length + line_length > max_length:
+            parts.append((start, end))
+            start, length = line_start, utf16_length(text[line_start:line_end])
+        else:
+            length += line_length
+        end = line_end
+    parts.append((start, end))
+    return [part for part in (strip(text, start, end) for start, end in parts) if part[0] < part[1]]
+
+
+def split_long_lines(text, max_length):
+    line_start = 0
+    for line in text.split('\n'):
+        line_end = line_start + len(line)
+        start = line_start
+        while utf16_length(text[start:line_end]) > max_length:
+            end = min(start + max_length, line_end)
+            while utf16_length(text[start:end]) > max_length:  # characters outside the BMP count twice
+                end -= 1
+            space = text.rfind(' ', start, min(end + 1, line_end))  # a space right after the limit is left out too
+            if space > start:
+                yield start, space
+                start = space + 1
+            else:
+                yield start, end
+                start = end
+        yield start, line_end
+        line_start = line_end + 1
+
+
+def strip(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def to_entities(text: str, spans: list[Span]) -> tuple[MessageEntity, ...]:
+    entities = []
+    for span in spans:
+        if span.end <= span.start:
+            continue
+        offset = utf16_length(text[:span.start])
+        length = utf16_length(text[span.start:span.end])
+        entities.append(MessageEntity(span.type, offset, length, url=span.url, language=span.language))
+    return tuple(entities)
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
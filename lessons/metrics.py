@@ -0,0 +1,255 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+registry = []
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """Minimal Prometheus style metric, rendered in the text exposition format by render()"""
+    type = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        """:param function: if given, the value is read from it when rendering"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.values = {}  # label values -> value
+        self.lock = threading.Lock()  # database metrics are updated from the async ORM threads
+        if not labels and self.type != 'histogram':
+            self.values[()] = 0
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        if self.function:
+            return [(self.name, self.function())]
+        with self.lock:
+            return [(f'{self.name}{self.format_labels(key)}', value) for key, value in self.values.items()]
+
+    def render(self, worker=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{add_worker_label(name, worker)} {format_value(value)}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    samples.append((f'{self.name}_bucket{self.format_labels(key, ("le", bound))}', count))
+                samples.append((f'{self.name}_sum{self.format_labels(key)}', total))
+                samples.append((f'{self.name}_count{self.format_labels(key)}', counts[-1]))
+        return samples
+
+
+def timed(histogram, **labels):
+    """Decorator for async functions, observing their duration labeled with the function name"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**{'function': fn.__name__, **labels}):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def add_worker_label(sample_name, worker):
+    if not worker:
+        return sample_name
+    label = f'worker="{escape(worker)}"'
+    if sample_name.endswith('}'):
+        return f'{sample_name[:-1]},{label}}}'
+    return f'{sample_name}{{{label}}}'
+
+
+def render(worker=None):
+    """:param worker: if given, added as a label to every sample, to tell apart the processes"""
+    return '\n'.join(metric.render(worker) for metric in registry) + '\n'
+
+
+def get_snapshot_path(directory, worker):
+    return os.path.join(directory, f'{worker}.prom')
+
+
+def write_snapshot(directory, worker):
+    path = get_snapshot_path(directory, worker)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render(worker))
+    os.replace(tmp_path, path)
+
+
+async def snapshot_loop(directory, worker, interval):
+    """
+    Writes the metrics of this process to its own file in directory periodically, so they can be served
+    by another process, see render_all. The file is removed when stopping.
+    """
+    os.makedirs(directory, exist_ok=True)
+    try:
+        while True:
+            try:
+                write_snapshot(directory, worker)
+            except OSError as e:
+                logger.error(f'Error writing metrics snapshot: {e}')
+            await asyncio.sleep(interval)
+    finally:
+        try:
+            os.remove(get_snapshot_path(directory, worker))
+        except OSError:
+            pass
+
+
+def read_snapshots(directory, max_age, exclude=None):
+    """Snapshots in directory written in the last max_age seconds, older ones are of processes that died"""
+    texts = []
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return texts
+    for name in names:
+        if not name.endswith('.prom') or name == f'{exclude}.prom':
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                continue
+            with open(path) as f:
+                texts.append(f.read())
+        except OSError:  # removed by a process stopping
+            continue
+    return texts
+
+
+def merge(texts):
+    """Merges the metrics of several processes, with the HELP and TYPE lines of each metric once"""
+    families = {}  # metric name -> lines
+    for text in texts:
+        lines, seen = [], True
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                seen = name in families
+                lines = families.setdefault(name, [])
+            if line and not (seen and line.startswith('#')):
+                lines.append(line)
+    return '\n'.join(line for lines in families.values() for line in lines) + '\n'
+
+
+def render_all(directory, max_age, worker):
+    """
+    Metrics of this process merged with the snapshots the other processes write to directory.
+    The ucdm_metrics_timestamp_seconds of each worker tells how old its snapshot is.
+    """
+    texts = [render(worker)]
+    if directory:
+        texts += read_snapshots(directory, max_age, exclude=worker)
+    return merge(texts)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection by the lessons app"""
+    with db_query_seconds.time(operation=sql.split(None, 1)[0].upper() if sql else ''):
+        return execute(sql, params, many, context)
+
+
+messages_sent = Counter('ucdm_messages_sent_total', 'Lesson messages sent')
+messages_failed = Counter('ucdm_messages_failed_total', 'Lesson messages that failed', labels=('error',))
+messages_retried = Counter('ucdm_messages_retried_total', 'Lesson messages queued to be sent again')
+chats_blocked = Counter('ucdm_chats_blocked_total', 'Chats that blocked the bot')
+chats_disabled = Counter('ucdm_chats_disabled_total', 'Chats that stopped receiving the lessons because of errors',
+                         labels=('reason',))
+chats_migrated = Counter('ucdm_chats_migrated_total', 'Groups upgraded to supergroups, with a new chat_id')
+telegram_request_seconds = Histogram('ucdm_telegram_request_seconds', 'Telegram API request latency',
+                                     labels=('endpoint',))
+db_query_seconds = Histogram('ucdm_db_query_seconds', 'Database query latency', labels=('operation',))
+function_seconds = Histogram('ucdm_function_seconds', 'Duration of instrumented functions and update handlers',
+                             labels=('function',))
+rate_limit_wait_seconds = Histogram('ucdm_rate_limit_wait_seconds', 'Time requests waited for the rate limiter',
+                                    labels=('priority',))
+telegram_pool_wait_seconds = Histogram('ucdm_telegram_pool_wait_seconds', 'Time waiting for a free HTTP connection',
+                                       labels=('pool',))
+due_chats = Gauge('ucdm_due_chats', 'Chats due that were not sent yet in the running send all')
+pending_messages = Gauge('ucdm_pending_messages', 'Messages waiting in the retry queue')
+updates_waiting = Gauge('ucdm_updates_waiting', 'Updates waiting for a previous update of the chat or a free slot')
+updates_processing = Gauge('ucdm_updates_processing', 'Updates being processed by the handlers')
+update_wait_seconds = Histogram('ucdm_update_wait_seconds', 'Time an update waited before being processed')
+metrics_timestamp = Gauge('ucdm_metrics_timestamp_seconds', 'Time the metrics of the worker were rendered',
+                          function=time.time)
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0004_chat_username'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lesson_number', models.IntegerField()),
+                ('language', models.CharField(max_length=8)),
+                ('part', models.IntegerField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True)),
+                ('error', models.CharField(blank=True, max_length=1024, null=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lessons.chat')),
+            ],
+            options={
+                'ordering': ['chat', 'lesson_number', 'part'],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0005_pendingmessage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['send_lesson', 'last_sent'], name='chat_due_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0006_chat_due_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chat',
+            name='chat_due_idx',
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='send_hour',
+            field=models.PositiveSmallIntegerField(default=8),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='timezone',
+            field=models.CharField(default='America/Argentina/Buenos_Aires', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['send_lesson', 'timezone', 'send_hour', 'last_sent'], name='chat_due_idx'),
+        ),
+    ]
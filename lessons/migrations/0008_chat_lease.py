@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0007_chat_timezone_send_hour'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0008_chat_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('lesson_number', models.IntegerField()),
+                ('part', models.IntegerField()),
+                ('message_id', models.BigIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed')], default='sent', max_length=8)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lessons.chat')),
+            ],
+            options={
+                'verbose_name_plural': 'deliveries',
+                'constraints': [models.UniqueConstraint(fields=('chat', 'date', 'lesson_number', 'part'), name='delivery_unique')],
+            },
+        ),
+    ]
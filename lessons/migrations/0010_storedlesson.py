@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0009_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredLesson',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel_id', models.BigIntegerField()),
+                ('lesson_number', models.IntegerField()),
+                ('language', models.CharField(max_length=8)),
+                ('part', models.IntegerField()),
+                ('message_id', models.BigIntegerField()),
+                ('text_hash', models.CharField(max_length=64)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('channel_id', 'lesson_number', 'language', 'part'), name='stored_lesson_unique')],
+            },
+        ),
+    ]
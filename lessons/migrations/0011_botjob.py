@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0010_storedlesson'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('refresh_names', 'Refresh names'), ('resend_lesson', 'Resend lesson'), ('calendar_mode', 'Calendar mode')], max_length=32)),
+                ('chat_ids', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done')], db_index=True, default='pending', max_length=8)),
+                ('total', models.IntegerField(default=0)),
+                ('done', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('owner', models.CharField(blank=True, max_length=64, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0011_botjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(unique=True)),
+                ('data', models.BinaryField()),
+                ('updated', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name_plural': 'chat data',
+            },
+        ),
+        migrations.CreateModel(
+            name='ConversationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32)),
+                ('key', models.CharField(max_length=64)),
+                ('state', models.BinaryField()),
+                ('updated', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'key'), name='conversation_state_unique')],
+            },
+        ),
+    ]
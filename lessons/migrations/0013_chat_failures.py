@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0012_conversation_persistence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='chat',
+            name='chat_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+    ]
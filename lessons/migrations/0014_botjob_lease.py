@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0013_chat_failures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botjob',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='botjob',
+            name='processed_ids',
+            field=models.JSONField(default=list),
+        ),
+    ]
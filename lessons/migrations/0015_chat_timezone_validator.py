@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:49
+
+import lessons.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0014_botjob_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='timezone',
+            field=models.CharField(default='America/Argentina/Buenos_Aires', max_length=64, validators=[lessons.models.validate_timezone]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0015_chat_timezone_validator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingmessage',
+            name='date',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
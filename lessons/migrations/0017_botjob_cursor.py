@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0016_pendingmessage_date'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='botjob',
+            name='processed_ids',
+        ),
+        migrations.AddField(
+            model_name='botjob',
+            name='cursor',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,18 +1,163 @@
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 
 
+def is_valid_timezone(timezone):
+    try:
+        ZoneInfo(timezone)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def validate_timezone(timezone):
+    if not is_valid_timezone(timezone):
+        raise ValidationError(f'Unknown timezone "{timezone}", use a name like America/Mexico_City')
+
+
 class Chat(models.Model):
-    chat_id = models.IntegerField(unique=True)
+    chat_id = models.BigIntegerField(unique=True)  # supergroup ids don't fit in 32 bits
     is_group = models.BooleanField(default=False)
     is_calendar = models.BooleanField(default=True)
     username = models.CharField(max_length=1024, null=True, blank=True)  # username or group name
     language = models.CharField(max_length=8, default='es')
     send_lesson = models.BooleanField(default=False)
     last_sent = models.DateField(null=True, blank=True)
-    last_lesson_sent = models.IntegerField(blank=True, null=True)
+    last_lesson_sent = models.IntegerField(blank=True, null=True)  # last_sent is a date in the chat's timezone
+    timezone = models.CharField(max_length=64, default=settings.TIME_ZONE, validators=[validate_timezone])
+    send_hour = models.PositiveSmallIntegerField(default=8)  # local hour from which the lesson is sent
+    lease_owner = models.CharField(max_length=64, null=True, blank=True)  # worker sending to the chat
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    failures = models.PositiveIntegerField(default=0)  # lessons in a row that failed, see bot.sweep_failing_chats
+
+    # fields loaded when sending lessons
+    SEND_FIELDS = ['id', 'chat_id', 'is_group', 'is_calendar', 'username', 'language', 'send_lesson',
+                   'last_sent', 'last_lesson_sent', 'timezone', 'send_hour', 'failures']
+    LEASE_FIELDS = ['lease_owner', 'lease_expires']
+    # fields the handlers branch on, changed behind the chat cache by the admin and the processes sending lessons
+    REFRESH_FIELDS = ['send_lesson', 'is_calendar', 'language', 'last_sent', 'last_lesson_sent', 'timezone', 'send_hour']
+
+    class Meta:
+        indexes = [models.Index(fields=['send_lesson', 'timezone', 'send_hour', 'last_sent'], name='chat_due_idx')]
 
     def __str__(self):
         type_str = 'chat' if not self.is_group else 'group'
         username_str = f'_{self.username}' if self.username else ''
         return f'{type_str}_{self.chat_id}{username_str}'
 
+
+
+class PendingMessage(models.Model):
+    """A lesson part that failed with a transient error and is waiting to be sent again"""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    lesson_number = models.IntegerField()
+    language = models.CharField(max_length=8)
+    part = models.IntegerField()
+    date = models.DateField(null=True, blank=True)  # of the lesson in the chat's timezone, null if queued before it
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    error = models.CharField(max_length=1024, null=True, blank=True)
+
+    class Meta:
+        ordering = ['chat', 'lesson_number', 'part']
+
+    def __str__(self):
+        return f'{self.chat} - lesson {self.lesson_number + 1} part {self.part + 1} ({self.language})'
+
+
+class Delivery(models.Model):
+    """A lesson part sent to a chat, so that a lesson interrupted by a restart is resumed instead of sent again"""
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = [(SENT, 'Sent'), (FAILED, 'Failed')]
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)  # in the chat's timezone
+    lesson_number = models.IntegerField()
+    part = models.IntegerField()
+    message_id = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=8, choices=STATUSES, default=SENT)
+
+    class Meta:
+        verbose_name_plural = 'deliveries'
+        constraints = [models.UniqueConstraint(fields=['chat', 'date', 'lesson_number', 'part'], name='delivery_unique')]
+
+    def __str__(self):
+        return f'{self.chat} - {self.date} lesson {self.lesson_number + 1} part {self.part + 1} {self.status}'
+
+
+class StoredLesson(models.Model):
+    """A lesson part posted to the storage channel, copied to the chats instead of uploading the text every time"""
+    channel_id = models.BigIntegerField()
+    lesson_number = models.IntegerField()
+    language = models.CharField(max_length=8)
+    part = models.IntegerField()
+    message_id = models.BigIntegerField()
+    text_hash = models.CharField(max_length=64)  # to edit the message when the workbook changes
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['channel_id', 'lesson_number', 'language', 'part'],
+                                               name='stored_lesson_unique')]
+
+    def __str__(self):
+        return f'lesson {self.lesson_number + 1} part {self.part + 1} ({self.language}) - message {self.message_id}'
+
+
+class BotJob(models.Model):
+    """An admin action on many chats, run in the background by the bot process"""
+    REFRESH_NAMES = 'refresh_names'
+    RESEND_LESSON = 'resend_lesson'
+    CALENDAR_MODE = 'calendar_mode'
+    ACTIONS = [(REFRESH_NAMES, 'Refresh names'), (RESEND_LESSON, 'Resend lesson'), (CALENDAR_MODE, 'Calendar mode')]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done')]
+
+    action = models.CharField(max_length=32, choices=ACTIONS)
+    chat_ids = models.JSONField()  # Chat.chat_id of the selected chats, in pk order
+    status = models.CharField(max_length=8, choices=STATUSES, default=PENDING, db_index=True)
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    cursor = models.BigIntegerField(default=0)  # pk of the chat up to which all were processed, resumed after it
+    owner = models.CharField(max_length=64, null=True, blank=True)  # WORKER_ID of the process running it
+    lease_expires = models.DateTimeField(null=True, blank=True)  # renewed while running, another process resumes it after
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return f'{self.get_action_display()} - {self.done + self.failed}/{self.total} {self.status}'
+
+
+class ConversationState(models.Model):
+    """The state of a user in a ConversationHandler, so a restart doesn't drop the conversation"""
+    name = models.CharField(max_length=32)  # name of the ConversationHandler
+    key = models.CharField(max_length=64)  # conversation key, like [chat_id, user_id], as JSON
+    state = models.BinaryField()  # pickled, states are enums
+    updated = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['name', 'key'], name='conversation_state_unique')]
+
+    def __str__(self):
+        return f'{self.name} {self.key}'
+
+
+class ChatData(models.Model):
+    """The context.chat_data of the bot handlers"""
+    chat_id = models.BigIntegerField(unique=True)
+    data = models.BinaryField()  # pickled dict
+    updated = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = 'chat data'
+
+    def __str__(self):
+        return f'chat {self.chat_id}'
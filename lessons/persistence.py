@@ -0,0 +1,136 @@
+import json
+import pickle
+import asyncio
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from telegram.ext import BasePersistence, PersistenceInput
+
+from .models import ConversationState, ChatData
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Stores the conversation states and chat data in the database.
+    The application hands the changes over every PERSISTENCE_INTERVAL seconds and they are written in a single batch.
+    Chat data is loaded the first time a chat sends an update. Conversation states are read when the application
+    starts, as the handlers look them up synchronously, but only the ones that haven't timed out.
+    """
+    def __init__(self):
+        super().__init__(store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False),
+                         update_interval=settings.PERSISTENCE_INTERVAL)
+        self.conversations = {}  # (name, key) -> state, None to delete
+        self.chat_data = {}  # chat_id -> data, empty to delete
+        self.stored_chat_data = {}  # chat_id -> last pickled data or None, to write only the changes
+        self.write_task = None
+        self.lock = asyncio.Lock()
+
+    async def get_conversations(self, name):
+        expired = timezone.now() - timedelta(seconds=settings.CONVERSATION_TIMEOUT)
+        await ConversationState.objects.filter(name=name, updated__lt=expired).adelete()
+        conversations = {tuple(json.loads(state.key)): pickle.loads(state.state)
+                         async for state in ConversationState.objects.filter(name=name)}
+        logger.info(f'Loaded {len(conversations)} {name} conversations')
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        self.conversations[(name, json.dumps(key))] = new_state
+        self.schedule_write()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if chat_id in self.stored_chat_data:
+            return
+        stored = await ChatData.objects.filter(chat_id=chat_id).values_list('data', flat=True).afirst()
+        if stored is not None:
+            chat_data.update(pickle.loads(stored))
+        self.stored_chat_data[chat_id] = stored and bytes(stored)
+
+    async def update_chat_data(self, chat_id, data):
+        """Called for every chat that sent an update, even if its data didn't change"""
+        if (pickle.dumps(data) if data else None) != self.stored_chat_data.get(chat_id):
+            self.chat_data[chat_id] = data
+            self.schedule_write()
+
+    async def drop_chat_data(self, chat_id):
+        self.chat_data[chat_id] = {}
+        self.schedule_write()
+
+    def schedule_write(self):
+        """
+        The application calls the update methods together and then the changes are written by a single task,
+        which runs after all of them.
+        """
+        if not self.write_task or self.write_task.done():
+            self.write_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self.lock:
+            while self.conversations or self.chat_data:
+                conversations, self.conversations = self.conversations, {}
+                chat_data, self.chat_data = self.chat_data, {}
+                try:
+                    await self.write(conversations, chat_data)
+                except Exception as e:
+                    logger.exception(f'Error writing conversation states and chat data: {e}')
+                    # written with the next changes, unless there are newer ones
+                    self.conversations = {**conversations, **self.conversations}
+                    self.chat_data = {**chat_data, **self.chat_data}
+                    return
+
+    async def write(self, conversations, chat_data):
+        now = timezone.now()
+        deleted = [Q(name=name, key=key) for (name, key), state in conversations.items() if state is None]
+        if deleted:
+            await ConversationState.objects.filter(Q(*deleted, _connector=Q.OR)).adelete()
+        states = [ConversationState(name=name, key=key, state=pickle.dumps(state), updated=now)
+                  for (name, key), state in conversations.items() if state is not None]
+        if states:
+            await ConversationState.objects.abulk_create(states, update_conflicts=True, unique_fields=['name', 'key'],
+                                                         update_fields=['state', 'updated'])
+        deleted = [chat_id for chat_id, data in chat_data.items() if not data]
+        if deleted:
+            await ChatData.objects.filter(chat_id__in=deleted).adelete()
+        rows = [ChatData(chat_id=chat_id, data=pickle.dumps(data), updated=now)
+                for chat_id, data in chat_data.items() if data]
+        if rows:
+            await ChatData.objects.abulk_create(rows, update_conflicts=True, unique_fields=['chat_id'],
+                                                update_fields=['data', 'updated'])
+        for chat_id, data in chat_data.items():
+            self.stored_chat_data[chat_id] = pickle.dumps(data) if data else None
+        logger.debug(f'Persisted {len(conversations)} conversation states and {len(chat_data)} chat data')
+
+    # bot data, user data and callback data are not used by the handlers
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_user_data(self):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
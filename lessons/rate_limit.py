@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import time
+import logging
+from enum import IntEnum
+from itertools import count
+from django.conf import settings
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """
+    Passed as rate_limit_args to the bot methods, lower values go first when waiting for the global budget.
+    Requests without it, like the replies to the updates, are interactive.
+    """
+    INTERACTIVE = 0
+    RESEND = 1  # sending the lesson after the chat changed its settings, or from the admin
+    BROADCAST = 2  # the daily lessons and their retries
+
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    retry_after = e.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum tokens that can be accumulated, i.e. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self, tokens=1):
+        """More tokens than the capacity can be taken at once, the next acquire waits until they are paid back"""
+        needed = min(tokens, self.capacity)
+        async with self.lock:  # asyncio.Lock is FIFO, so waiters are served in order
+            self.refill()
+            while self.tokens < needed:
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= tokens
+
+
+class PriorityTokenBucket(TokenBucket):
+    """TokenBucket where the waiters are served by priority, and in order within the same priority"""
+    def __init__(self, rate, capacity=1):
+        super().__init__(rate, capacity)
+        self.waiters = []  # heap of (priority, arrival)
+        self.arrivals = count()
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def acquire(self, tokens=1, priority=Priority.INTERACTIVE):
+        needed = min(tokens, self.capacity)
+        waiter = (priority, next(self.arrivals))
+        heapq.heappush(self.waiters, waiter)
+        try:
+            while True:
+                changed = self.changed
+                timeout = None  # until the waiters change, if it's not the first one
+                if self.waiters[0] == waiter:
+                    self.refill()
+                    if self.tokens >= needed:
+                        self.tokens -= tokens
+                        return
+                    timeout = (needed - self.tokens) / self.rate
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except TimeoutError:
+                    pass
+        finally:
+            self.waiters.remove(waiter)
+            heapq.heapify(self.waiters)
+            self.notify()
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Throttles all outgoing requests to stay under Telegram's limits:
+    a global messages per second budget plus a budget per private chat and per group.
+    The global budget is shared by both bots and given first to the requests with the highest Priority.
+    On a RetryAfter all requests are paused for the time requested by the server and the error is re-raised.
+    """
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        # no burst, a full bucket would let twice the limit through in a second, also after every flood control pause
+        self.global_bucket = PriorityTokenBucket(settings.TELEGRAM_RATE_LIMIT, capacity=1)
+        self.chat_buckets = {}
+        self.paused_until = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self.prune()
+            is_group = chat_id < 0
+            rate = settings.TELEGRAM_GROUP_RATE_LIMIT if is_group else settings.TELEGRAM_CHAT_RATE_LIMIT
+            bucket = TokenBucket(rate)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def prune(self):
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_full() and not bucket.lock.locked()]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+
+    async def wait_pause(self):
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = None
+        messages = len(data.get('message_ids') or ()) or 1  # copyMessages and forwardMessages send many
+        priority = Priority(rate_limit_args) if rate_limit_args is not None else Priority.INTERACTIVE
+        start = time.monotonic()
+        await self.wait_pause()
+        if chat_id is not None:
+            await self.get_chat_bucket(chat_id).acquire(messages)
+            await self.global_bucket.acquire(messages, priority)
+        metrics.rate_limit_wait_seconds.observe(time.monotonic() - start, priority=priority.name.lower())
+        try:
+            with metrics.telegram_request_seconds.time(endpoint=endpoint):
+                return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+            logger.warning(f'Flood control on {endpoint} - pausing requests for {retry_after} seconds')
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            raise
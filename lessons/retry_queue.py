@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from datetime import date, timedelta
+from itertools import groupby
+from django.conf import settings
+from django.utils import timezone
+from telegram.error import TelegramError, RetryAfter, ChatMigrated
+
+from . import bot as bot_module, metrics
+from .dispatcher import dispatch
+from .models import PendingMessage
+from .rate_limit import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_delay(error: TelegramError, attempts: int) -> float:
+    if isinstance(error, RetryAfter):
+        return retry_after_seconds(error) + 1
+    return min(settings.RETRY_MAX_DELAY, settings.RETRY_BASE_DELAY * 2 ** attempts)
+
+
+async def enqueue(chat, day: date, lesson_number, language, parts, error: TelegramError):
+    """
+    Queues the given parts of the lesson of day to be sent again later.
+    All the parts share the same next attempt time so that they are sent in order.
+    """
+    next_attempt = timezone.now() + timedelta(seconds=get_retry_delay(error, 0))
+    logger.warning(f'{chat} - queueing {len(parts)} parts of lesson {lesson_number + 1} for retry: {error}')
+    metrics.messages_retried.inc(len(parts))
+    await PendingMessage.objects.abulk_create([
+        PendingMessage(chat=chat, date=day, lesson_number=lesson_number, language=language, part=part,
+                       next_attempt=next_attempt, error=str(error)[:1024])
+        for part in parts
+    ])
+
+
+async def retry_pending() -> timedelta | None:
+    """
+    Sends the pending messages that are due.
+    :return: time until the next pending message is due, or None if the queue is empty
+    """
+    now = timezone.now()
+    pending = [p async for p in PendingMessage.objects.filter(next_attempt__lte=now).select_related('chat')]
+    if pending:
+        by_chat = [list(chat_pending) for _, chat_pending in groupby(pending, key=lambda p: p.chat_id)]
+        logger.info(f'Retrying {len(pending)} pending messages for {len(by_chat)} chats')
+        stats = await dispatch(by_chat, retry_chat)
+        logger.info(f'Retry - {stats}')
+    metrics.pending_messages.set(await PendingMessage.objects.acount())
+    next_pending = await PendingMessage.objects.order_by('next_attempt').afirst()
+    return next_pending and max(next_pending.next_attempt - timezone.now(), timedelta(0))
+
+
+async def retry_chat(pending: list[PendingMessage]) -> int:
+    chat = pending[0].chat
+    if not await bot_module.claim_chat(chat):  # being sent to by another worker, retried later
+        return 0
+    try:
+        # read again after claiming, another worker might have sent them already
+        pending = [p async for p in PendingMessage.objects.filter(chat=chat, next_attempt__lte=timezone.now())
+                   .select_related('chat')]
+        return await retry_messages(chat, pending)
+    finally:
+        bot_module.release_chat(chat)
+
+
+async def retry_messages(chat, pending: list[PendingMessage]) -> int:
+    for i, message in enumerate(pending):
+        try:
+            await bot_module.send_lesson_part(chat, message.date, message.lesson_number, message.language, message.part)
+        except TelegramError as e:
+            metrics.messages_failed.inc(error=type(e).__name__)
+            remaining = [p.pk for p in pending[i:]]
+            if isinstance(e, ChatMigrated) and not await bot_module.migrate_chat(chat, e.new_chat_id):
+                await PendingMessage.objects.filter(chat=chat).adelete()
+            elif reason := bot_module.get_dead_chat_reason(e):
+                bot_module.disable_chat(chat, reason)
+                await PendingMessage.objects.filter(chat=chat).adelete()
+            elif not bot_module.is_retryable_error(e) or message.attempts + 1 >= settings.RETRY_MAX_ATTEMPTS:
+                logger.error(f'{message} - giving up after {message.attempts + 1} attempts: {e}')
+                bot_module.record_failure(chat)
+                await PendingMessage.objects.filter(pk__in=remaining).adelete()
+            else:
+                next_attempt = timezone.now() + timedelta(seconds=get_retry_delay(e, message.attempts + 1))
+                await PendingMessage.objects.filter(pk__in=remaining) \
+                    .aupdate(attempts=message.attempts + 1, next_attempt=next_attempt, error=str(e)[:1024])
+            return i
+        await message.adelete()
+    return len(pending)
+
+
+async def retry_loop():
+    logger.info('Starting retry loop')
+    while True:
+        delay = None
+        try:
+            delay = await retry_pending()
+        except Exception as e:
+            logger.exception(e)
+        delay = settings.RETRY_POLL_INTERVAL if delay is None else delay.total_seconds()
+        await asyncio.sleep(min(delay, settings.RETRY_POLL_INTERVAL))
@@ -0,0 +1,113 @@
+import heapq
+import asyncio
+import logging
+from itertools import count
+from datetime import datetime, timedelta, UTC
+from django.conf import settings
+
+from . import bot as bot_module
+from .dispatcher import dispatch, cancel_tasks
+
+logger = logging.getLogger(__name__)
+
+SEND_ALL = None  # heap entry for sending to all the due chats, instead of a single chat
+
+
+class Scheduler:
+    """
+    Sleeps until the next time something is due, instead of polling.
+    The heap holds the next time to send to all due chats, plus the chats that were woken up by a settings change.
+    All times are in UTC.
+    """
+    def __init__(self):
+        self.heap = []  # (when, sequence, chat_id or SEND_ALL)
+        self.sequence = count()
+        self.wakeup = asyncio.Event()
+        self.next_send_all = None
+        self.send_all_task = None
+        self.tasks = set()  # sends started by run, cancelled when it stops
+
+    def schedule(self, when: datetime, chat_id=SEND_ALL):
+        heapq.heappush(self.heap, (when, next(self.sequence), chat_id))
+        self.wakeup.set()
+
+    def schedule_send_all(self, when: datetime):
+        """Moves the next send to all due chats earlier, if needed"""
+        if self.next_send_all is None or when < self.next_send_all:
+            self.next_send_all = when
+            self.schedule(when)
+
+    def wake(self, chat_id, delay=None):
+        """Sends today's lesson to the chat after the delay, if it wasn't sent yet"""
+        delay = settings.SCHEDULER_WAKE_DELAY if delay is None else delay
+        self.schedule(datetime.now(UTC) + timedelta(seconds=delay), chat_id)
+
+    async def run(self):
+        logger.info('Starting scheduler')
+        self.schedule_send_all(datetime.now(UTC))
+        try:
+            while True:
+                await self.wait_next()
+                now = datetime.now(UTC)
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    when, _, chat_id = heapq.heappop(self.heap)
+                    if chat_id is not SEND_ALL or when == self.next_send_all:  # skip send alls that were moved earlier
+                        due.append(chat_id)
+                chat_ids = {chat_id for chat_id in due if chat_id is not SEND_ALL}
+                if chat_ids:
+                    self.start(self.send_chats(chat_ids))
+                if SEND_ALL in due:
+                    self.next_send_all = None
+                    if self.send_all_task and not self.send_all_task.done():
+                        logger.warning('Previous send all still running')
+                    else:
+                        self.send_all_task = self.start(self.send_all())
+        finally:
+            # the sends must finish before run_send_loops writes the chats and deliveries
+            await cancel_tasks(self.tasks)
+
+    def start(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def wait_next(self):
+        while True:
+            self.wakeup.clear()
+            delay = (self.heap[0][0] - datetime.now(UTC)).total_seconds() if self.heap else None
+            if delay is not None and delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except TimeoutError:
+                pass
+
+    async def send_all(self):
+        try:
+            await bot_module.try_send_all()
+            next_time = await bot_module.get_next_send_all_time(datetime.now(UTC))
+        except Exception as e:
+            logger.exception(e)
+            next_time = datetime.now(UTC) + timedelta(seconds=settings.SCHEDULER_RESCAN_INTERVAL)
+        logger.info(f'Next send all at {next_time:%Y-%m-%d %H:%M} UTC')
+        self.schedule_send_all(next_time)
+
+    async def send_chats(self, chat_ids):
+        try:
+            stats = await dispatch(chat_ids, bot_module.send_today_if_due)
+            logger.info(f'Woken chats - {stats}')
+        except Exception as e:
+            logger.exception(e)
+
+
+lesson_scheduler = Scheduler()
+
+
+def wake(chat_id, delay=None):
+    lesson_scheduler.wake(chat_id, delay=delay)
+
+
+def schedule_send_all(when: datetime):
+    lesson_scheduler.schedule_send_all(when)
@@ -0,0 +1,58 @@
+from datetime import date
+
+from . import lesson_storage
+from .markdown import LessonMessage
+from .rate_limit import Priority
+from .workbook import get_lesson_messages, get_day_lesson_number
+
+COPY_MESSAGES_MAX = 100  # message ids per copyMessages request
+
+
+class SendPlan:
+    """
+    What to send on a day in a timezone, shared by all the chats sent to in the same send all,
+    so the lesson of the day and its messages are worked out once instead of for every chat.
+    """
+    def __init__(self, today: date, priority=Priority.BROADCAST):
+        """
+        :param today: the date in the timezone of the chats
+        :param priority: of the messages in the rate limiter
+        """
+        self.today = today
+        self.priority = priority
+        self.calendar_lesson = get_day_lesson_number(today)
+        self.messages = {}  # (lesson_number, language) -> lesson messages
+        self.batches = {}  # (lesson_number, language, parts) -> parts sent with each request
+
+    def get_lesson_number(self, chat) -> int:
+        if chat.is_calendar:
+            return self.calendar_lesson
+        lesson_number = (chat.last_lesson_sent + 1) if chat.last_lesson_sent is not None else 0
+        if lesson_number < 0 or lesson_number > 364:
+            lesson_number = 0
+        return lesson_number
+
+    def get_messages(self, lesson_number, language) -> tuple[LessonMessage, ...]:
+        key = (lesson_number, language)
+        messages = self.messages.get(key)
+        if messages is None:
+            messages = self.messages[key] = get_lesson_messages(lesson_number, language)
+        return messages
+
+    async def get_batches(self, lesson_number, language, parts: list[int]) -> list[list[int]]:
+        key = (lesson_number, language, tuple(parts))
+        batches = self.batches.get(key)
+        if batches is None:
+            batches = self.batches[key] = await get_part_batches(lesson_number, language, parts)
+        return batches
+
+
+async def get_part_batches(lesson_number, language, parts) -> list[list[int]]:
+    """Parts sent with a single request. Copying many messages at once needs their ids in increasing order."""
+    if not lesson_storage.is_enabled():
+        return [[part] for part in parts]
+    message_ids = await lesson_storage.get_message_ids(lesson_number, language)
+    batch_ids = [message_ids[part] for part in parts]
+    if batch_ids != sorted(batch_ids):
+        return [[part] for part in parts]
+    return [parts[i:i + COPY_MESSAGES_MAX] for i in range(0, len(parts), COPY_MESSAGES_MAX)]
@@ -0,0 +1,33 @@
+import time
+import logging
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Times the phases of the bot startup, from the creation of the timer until the bot receives updates.
+    Only imports the standard library, so it can be imported before django.setup().
+    """
+    def __init__(self):
+        self.start = self.last = time.monotonic()
+        self.phases = []  # (name, seconds)
+
+    def phase(self, name):
+        """Marks the end of a phase, which started when the previous one ended"""
+        now = time.monotonic()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = self.last - self.start
+        for name, seconds in self.phases:
+            startup_seconds.set(round(seconds, 3), phase=name)
+        startup_seconds.set(round(total, 3), phase='total')
+        logger.info(f'Started in {total:.2f}s - ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases))
+
+
+startup_seconds = metrics.Gauge('ucdm_startup_seconds', 'Duration of the phases of the last startup', labels=('phase',))
+startup_timer = StartupTimer()
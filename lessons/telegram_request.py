@@ -0,0 +1,33 @@
+import time
+import asyncio
+from django.conf import settings
+from telegram.request import HTTPXRequest
+
+from . import metrics
+
+
+class PooledRequest(HTTPXRequest):
+    """
+    HTTPXRequest that waits for a free connection before making the request, instead of failing with a
+    PoolTimeout after pool_timeout seconds, and measures that wait.
+    """
+    def __init__(self, pool, connection_pool_size, **kwargs):
+        """:param pool: name of the pool in the metrics"""
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.pool = pool
+        self.connections = asyncio.Semaphore(connection_pool_size)
+
+    async def do_request(self, *args, **kwargs):
+        start = time.monotonic()
+        async with self.connections:
+            metrics.telegram_pool_wait_seconds.observe(time.monotonic() - start, pool=self.pool)
+            return await super().do_request(*args, **kwargs)
+
+
+def build_request(pool, connection_pool_size) -> PooledRequest:
+    return PooledRequest(pool, connection_pool_size,
+                         connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+                         read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+                         write_timeout=settings.TELEGRAM_WRITE_TIMEOUT,
+                         pool_timeout=settings.TELEGRAM_POOL_TIMEOUT,
+                         http_version=settings.TELEGRAM_HTTP_VERSION)
@@ -1,3 +1,726 @@
-from django.test import TestCase
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import logging
+from unittest import mock
+from datetime import datetime, timedelta, UTC
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, TestCase, AsyncClient, override_settings
+from django.urls import reverse
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import ExtBot
 
-# Create your tests here.
+from . import bot, bot_jobs, workbook, metrics, retry_queue, lesson_storage
+from .rate_limit import TelegramRateLimiter, TokenBucket, PriorityTokenBucket, Priority
+from .update_processor import UpdateQueue
+from .models import Chat, BotJob, PendingMessage, Delivery, StoredLesson, ConversationState, ChatData
+from .write_buffer import chat_writes
+from .chat_cache import chat_cache
+from .deliveries import deliveries
+from .markdown import compile_texts, split_text, LessonMessage
+from .send_plan import SendPlan
+from .log import ThrottledAdminEmailHandler
+from .persistence import DatabasePersistence
+from .fake_telegram import FakeTelegramServer
+from .scheduler import Scheduler
+from .dispatcher import dispatch
+
+TODAY = datetime(2026, 3, 10).date()
+
+
+class LeaseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for chat_id in range(1, 6):
+            Chat.objects.create(chat_id=chat_id, send_lesson=True, timezone='UTC', send_hour=8)
+
+    def setUp(self):
+        chat_writes.pending.clear()
+
+    async def claim(self, worker_id):
+        with override_settings(WORKER_ID=worker_id):
+            return await bot.claim_due_chats(TODAY, 'UTC', 8)
+
+    async def test_claimed_chats_are_not_claimed_by_another_worker(self):
+        with override_settings(SEND_CHUNK_SIZE=3):
+            first = await self.claim('a')
+            second = await self.claim('b')
+            third = await self.claim('b')
+        self.assertEqual([chat.chat_id for chat in first], [1, 2, 3])
+        self.assertEqual([chat.chat_id for chat in second], [4, 5])
+        self.assertEqual(third, [])
+        self.assertEqual(await Chat.objects.filter(lease_owner='a').acount(), 3)
+
+    async def test_released_chats_can_be_claimed_again(self):
+        claimed = await self.claim('a')
+        for chat in claimed[:2]:
+            bot.release_chat(chat)
+        self.assertEqual(await self.claim('b'), [])  # released in the buffer, not written yet
+        await chat_writes.flush()
+        self.assertEqual([chat.chat_id for chat in await self.claim('b')], [1, 2])
+
+    async def test_expired_leases_are_claimed_again(self):
+        await self.claim('a')
+        await Chat.objects.filter(chat_id__in=[4, 5]).aupdate(lease_expires=datetime.now(UTC) - timedelta(seconds=1))
+        self.assertEqual([chat.chat_id for chat in await self.claim('b')], [4, 5])
+
+    async def test_claim_chat(self):
+        chat = await Chat.objects.aget(chat_id=1)
+        with override_settings(WORKER_ID='a'):
+            self.assertTrue(await bot.claim_chat(chat, TODAY))
+        other = await Chat.objects.aget(chat_id=1)
+        with override_settings(WORKER_ID='b'):
+            self.assertFalse(await bot.claim_chat(other, TODAY))
+        await Chat.objects.filter(chat_id=1).aupdate(last_sent=TODAY, lease_owner=None, lease_expires=None)
+        with override_settings(WORKER_ID='b'):
+            self.assertFalse(await bot.claim_chat(other, TODAY))  # not due anymore
+            self.assertTrue(await bot.claim_chat(other))
+
+    async def test_iteration_continues_after_short_chunks(self):
+        await self.claim_chat_ids('b', [2, 4])
+        with override_settings(WORKER_ID='a', SEND_CHUNK_SIZE=2):
+            iterated = [chat.chat_id async for chat in bot.iterate_due_chats(TODAY, 'UTC', 8)]
+        self.assertEqual(iterated, [1, 3, 5])
+
+    async def claim_chat_ids(self, worker_id, chat_ids):
+        for chat_id in chat_ids:
+            with override_settings(WORKER_ID=worker_id):
+                await bot.claim_chat(await Chat.objects.aget(chat_id=chat_id))
+
+
+class WakeTests(TestCase):
+    def setUp(self):
+        chat_writes.pending.clear()
+        chat_cache.clear()
+
+    async def start(self, local_now):
+        """Sends /start at local_now and runs the scheduled wake"""
+        chat = await Chat.objects.acreate(chat_id=1, timezone='UTC', send_hour=8)
+        with mock.patch.object(bot, 'bot', mock.AsyncMock()), mock.patch.object(bot.scheduler, 'wake') as wake, \
+                mock.patch.object(bot, 'get_chat_now', return_value=local_now), \
+                mock.patch.object(bot, 'do_send_now', mock.AsyncMock(return_value=2)) as do_send_now:
+            await bot.set_send_lesson(await bot.get_chat(1), True)
+            wake.assert_called_once_with(chat.chat_id, delay=settings.SCHEDULER_START_DELAY)
+            await bot.send_today_if_due(chat.chat_id)
+        return do_send_now
+
+    async def test_start_outside_the_send_hours_waits(self):
+        do_send_now = await self.start(datetime(2026, 3, 10, 2, tzinfo=UTC))
+        do_send_now.assert_not_called()
+
+    async def test_start_in_the_send_hours_sends(self):
+        do_send_now = await self.start(datetime(2026, 3, 10, 9, tzinfo=UTC))
+        do_send_now.assert_called_once()
+
+
+class ChatCacheConsistencyTests(TestCase):
+    def setUp(self):
+        chat_writes.pending.clear()
+        chat_cache.clear()
+
+    async def test_language_change_reads_the_lesson_sent_by_another_process(self):
+        await Chat.objects.acreate(chat_id=1, is_calendar=False, last_lesson_sent=10, last_sent=TODAY)
+        await bot.get_chat(1)  # cached
+        await Chat.objects.filter(chat_id=1).aupdate(last_lesson_sent=11)  # sent by a worker
+        await bot.set_language(1, 'en')
+        chat = await Chat.objects.aget(chat_id=1)
+        self.assertEqual((chat.language, chat.last_lesson_sent, chat.last_sent), ('en', 10, None))
+
+    async def test_changes_not_written_are_kept(self):
+        await Chat.objects.acreate(chat_id=1, is_calendar=False, last_lesson_sent=10)
+        chat = await bot.get_chat(1)
+        chat.last_lesson_sent = 11
+        chat_writes.add(chat, ['last_lesson_sent'])
+        await bot.refresh_chat_fields(chat)
+        self.assertEqual(chat.last_lesson_sent, 11)
+
+    async def test_start_reads_send_lesson_changed_in_the_admin(self):
+        await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        chat = await bot.get_chat(1)  # cached
+        await Chat.objects.filter(chat_id=1).aupdate(send_lesson=False)  # saved in the admin of another process
+        with mock.patch.object(bot.scheduler, 'wake') as wake:
+            await bot.set_send_lesson(chat, True, send_msg=False)
+        wake.assert_called_once()
+        self.assertEqual(chat_writes.get_fields(1), {'send_lesson', 'failures'})
+
+    async def test_chat_deleted_in_the_admin_is_created_again(self):
+        await Chat.objects.acreate(chat_id=1)
+        await bot.get_chat(1)  # cached
+        await Chat.objects.filter(chat_id=1).adelete()
+        await bot.set_language(1, 'en')
+        self.assertEqual((await Chat.objects.aget(chat_id=1)).language, 'en')
+
+
+class BotJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for chat_id in range(1, 6):
+            Chat.objects.create(chat_id=chat_id)
+
+    def setUp(self):
+        chat_writes.pending.clear()
+
+    async def claim(self, worker_id):
+        with override_settings(WORKER_ID=worker_id):
+            return await bot_jobs.claim_next_job()
+
+    async def test_running_job_is_claimed_after_its_lease_expires(self):
+        job = await BotJob.objects.acreate(action=BotJob.REFRESH_NAMES, chat_ids=[1, 2], total=2)
+        self.assertEqual((await self.claim('a')).pk, job.pk)
+        self.assertIsNone(await self.claim('b'))
+        await BotJob.objects.filter(pk=job.pk).aupdate(lease_expires=datetime.now(UTC) - timedelta(seconds=1))
+        resumed = await self.claim('b')
+        self.assertEqual((resumed.pk, resumed.owner), (job.pk, 'b'))
+
+    async def run_job(self, job, function):
+        with mock.patch.dict(bot_jobs.JOB_FUNCTIONS, {job.action: function}), override_settings(WORKER_ID=job.owner):
+            await bot_jobs.run_job(job)
+        return await BotJob.objects.aget(pk=job.pk)
+
+    async def test_resumed_job_skips_processed_chats(self):
+        cursor = (await Chat.objects.aget(chat_id=2)).pk
+        await BotJob.objects.acreate(action=BotJob.REFRESH_NAMES, chat_ids=[1, 2, 3, 4, 5], total=5, done=1, failed=1,
+                                     cursor=cursor, status=BotJob.RUNNING, owner='a',
+                                     lease_expires=datetime.now(UTC) - timedelta(seconds=1))
+        processed = []
+
+        async def refresh_name(chat):
+            processed.append(chat.chat_id)
+
+        job = await self.run_job(await self.claim('b'), refresh_name)
+        self.assertEqual(processed, [3, 4, 5])
+        self.assertEqual((job.status, job.done, job.failed, job.total), (BotJob.DONE, 4, 1, 5))
+        self.assertEqual(job.cursor, (await Chat.objects.aget(chat_id=5)).pk)
+
+    async def test_cursor_stops_at_the_first_chat_not_finished(self):
+        await BotJob.objects.acreate(action=BotJob.REFRESH_NAMES, chat_ids=[1, 2, 3], total=3)
+        job = await self.claim('a')
+        others_finished = asyncio.Event()
+        cursors = []
+
+        async def refresh_name(chat):
+            if chat.chat_id == 1:
+                await others_finished.wait()
+                await asyncio.sleep(0)  # the last one finishes
+                cursors.append(job.cursor)
+            elif chat.chat_id == 3:
+                others_finished.set()
+
+        job = await self.run_job(job, refresh_name)
+        self.assertEqual(cursors, [0])  # 2 and 3 finished before 1
+        self.assertEqual(job.cursor, (await Chat.objects.aget(chat_id=3)).pk)
+
+    async def test_calendar_mode_keeps_the_lesson_sent_today(self):
+        await Chat.objects.filter(chat_id=1).aupdate(is_calendar=False, last_lesson_sent=10, last_sent=TODAY)
+        job = await BotJob.objects.acreate(action=BotJob.CALENDAR_MODE, chat_ids=[1], total=1)
+        with mock.patch.object(bot.scheduler, 'wake') as wake, override_settings(WORKER_ID='a'):
+            await bot_jobs.run_job(await self.claim('a'))
+        await chat_writes.flush()
+        chat = await Chat.objects.aget(chat_id=1)
+        self.assertEqual((chat.is_calendar, chat.last_lesson_sent, chat.last_sent), (True, None, TODAY))
+        wake.assert_not_called()
+
+
+class TimezoneTests(TestCase):
+    def test_invalid_timezone_is_not_valid(self):
+        Chat(chat_id=1, timezone='Europe/Madrid').full_clean()
+        with self.assertRaises(ValidationError):
+            Chat(chat_id=1, timezone='Europe/Nowhere').full_clean()
+
+    async def test_invalid_bucket_is_skipped(self):
+        await Chat.objects.acreate(chat_id=1, send_lesson=True, timezone='Europe/Madrid', send_hour=8,
+                                   last_sent=datetime.now(UTC).date() + timedelta(days=1))
+        await Chat.objects.acreate(chat_id=2, send_lesson=True, timezone='Europe/Nowhere', send_hour=8)
+        with self.assertLogs('lessons.bot', 'ERROR'):
+            self.assertEqual(await bot.get_send_buckets(), [('Europe/Madrid', 8)])
+            await bot.try_send_all()
+
+    def test_invalid_chat_timezone_uses_the_default(self):
+        now = bot.get_chat_now(Chat(chat_id=1, timezone='Europe/Nowhere'))
+        self.assertEqual(now.tzinfo.key, settings.TIME_ZONE)
+
+
+class RateLimiterTests(SimpleTestCase):
+    @override_settings(TELEGRAM_RATE_LIMIT=50, TELEGRAM_CHAT_RATE_LIMIT=1000)
+    async def test_global_limit_in_any_second(self):
+        limiter = TelegramRateLimiter()
+        sent = []
+
+        async def send():
+            sent.append(time.monotonic())
+
+        async def send_lesson(chat_id):
+            for _ in range(3):
+                await limiter.process_request(send, (), {}, 'sendMessage', {'chat_id': chat_id}, None)
+
+        await asyncio.gather(*(send_lesson(chat_id) for chat_id in range(50)))
+        max_in_second = max(sum(1 for t in sent if start <= t < start + 1) for start in sent)
+        self.assertLessEqual(max_in_second, 51)  # the rate plus the single token of burst
+
+
+class UpdateQueueTests(SimpleTestCase):
+    async def test_put_waits_for_pending_updates(self):
+        queue = UpdateQueue(max_pending=2)
+        await queue.put(1)
+        await queue.put(2)
+        put = asyncio.create_task(queue.put(3))
+        await queue.get()
+        await asyncio.sleep(0.01)
+        self.assertFalse(put.done())  # taken out of the queue but still being processed
+        queue.task_done()
+        await asyncio.wait_for(put, 1)
+        self.assertEqual(queue.pending, 2)
+
+
+class MarkdownTests(SimpleTestCase):
+    def test_entities(self):
+        [message] = compile_texts(['*Lección 1*\n\nNada _real_ puede ser [amenazado](https://acim.org) \\_x'])
+        self.assertEqual(message.text, 'Lección 1\n\nNada real puede ser amenazado _x')
+        self.assertEqual([(e.type, e.offset, e.length) for e in message.entities],
+                         [('bold', 0, 9), ('italic', 16, 4), ('text_link', 31, 9)])
+        self.assertEqual(message.entities[2].url, 'https://acim.org')
+
+    def test_offsets_are_in_utf16(self):
+        [message] = compile_texts(['🙏 *paz*'])
+        self.assertEqual((message.entities[0].offset, message.entities[0].length), (3, 3))
+
+    def test_unclosed_marker_is_text(self):
+        with self.assertLogs('lessons.markdown', 'WARNING'):
+            [message] = compile_texts(['2 * 3'])
+        self.assertEqual((message.text, message.entities), ('2 * 3', ()))
+
+    def test_texts_are_joined_and_split_at_line_breaks(self):
+        messages = compile_texts(['*aaaa\nbbbb*', 'cccc'], max_length=10)
+        self.assertEqual([m.text for m in messages], ['aaaa\nbbbb', 'cccc'])
+        messages = compile_texts(['*aaaa\nbbbb*', 'cccc'], max_length=6)
+        self.assertEqual([m.text for m in messages], ['aaaa', 'bbbb', 'cccc'])
+        # the entity crossing the split is cut in two
+        self.assertEqual([[(e.offset, e.length) for e in m.entities] for m in messages], [[(0, 4)], [(0, 4)], []])
+
+    def test_split_text(self):
+        self.assertEqual(split_text('aaa\nbbb\nccc', max_length=7), [(0, 7), (8, 11)])
+        self.assertEqual(split_text('aaa bbb ccc', max_length=7), [(0, 7), (8, 11)])  # at a space
+        self.assertEqual(split_text('aaaaaaaa', max_length=5), [(0, 5), (5, 8)])  # no space
+        self.assertEqual(split_text('  aaa  \n\n', max_length=10), [(2, 5)])
+        self.assertEqual(split_text('🙏🙏🙏', max_length=4), [(0, 2), (2, 3)])
+        self.assertEqual(split_text('🙏🙏🙏\nb c', max_length=4), [(0, 2), (2, 3), (4, 7)])
+
+
+class TokenBucketTests(SimpleTestCase):
+    async def test_rate(self):
+        bucket = TokenBucket(rate=50)
+        start = time.monotonic()
+        for _ in range(11):
+            await bucket.acquire()
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)  # the first token is there
+
+    async def test_priority(self):
+        bucket = PriorityTokenBucket(rate=50)
+        await bucket.acquire()
+        served = []
+
+        async def acquire(name, priority):
+            await bucket.acquire(priority=priority)
+            served.append(name)
+
+        await asyncio.gather(acquire('broadcast 1', Priority.BROADCAST), acquire('broadcast 2', Priority.BROADCAST),
+                             acquire('resend', Priority.RESEND), acquire('interactive', Priority.INTERACTIVE))
+        self.assertEqual(served, ['interactive', 'resend', 'broadcast 1', 'broadcast 2'])
+
+
+class SendTimeTests(SimpleTestCase):
+    def test_next_send_time(self):
+        cases = [  # now, timezone, send hour, next send time
+            (datetime(2026, 3, 10, 3, tzinfo=UTC), 'America/Argentina/Buenos_Aires', 8, datetime(2026, 3, 10, 11)),
+            (datetime(2026, 3, 11, 2, 30, tzinfo=UTC), 'America/Argentina/Buenos_Aires', 8, datetime(2026, 3, 11, 11)),
+            (datetime(2026, 3, 10, 0, tzinfo=UTC), 'Asia/Kolkata', 8, datetime(2026, 3, 10, 2, 30)),
+            (datetime(2026, 3, 9, 17, tzinfo=UTC), 'Pacific/Kiritimati', 8, datetime(2026, 3, 9, 18)),  # a day ahead
+            # the day before and the day of the change to summer time in Madrid
+            (datetime(2026, 3, 28, 0, 30, tzinfo=UTC), 'Europe/Madrid', 8, datetime(2026, 3, 28, 7)),
+            (datetime(2026, 3, 29, 0, 30, tzinfo=UTC), 'Europe/Madrid', 8, datetime(2026, 3, 29, 6)),
+            (datetime(2026, 10, 25, 0, 30, tzinfo=UTC), 'Europe/Madrid', 8, datetime(2026, 10, 25, 7)),
+        ]
+        for now, timezone, send_hour, expected in cases:
+            with self.subTest(now=now, timezone=timezone):
+                self.assertEqual(bot.get_next_send_time(now, timezone, send_hour), expected.replace(tzinfo=UTC))
+
+    def test_inside_send_hours_rescans(self):
+        now = datetime(2026, 3, 10, 12, tzinfo=UTC)  # 9 in Buenos Aires
+        self.assertEqual(bot.get_next_send_time(now, 'America/Argentina/Buenos_Aires', 8),
+                         now + timedelta(seconds=settings.SCHEDULER_RESCAN_INTERVAL))
+
+
+class WriteBufferTests(TestCase):
+    def setUp(self):
+        chat_writes.pending.clear()
+
+    async def test_flush(self):
+        chat = await Chat.objects.acreate(chat_id=1)
+        chat.last_lesson_sent = 5
+        chat_writes.add(chat, ['last_lesson_sent'])
+        other = await Chat.objects.aget(chat_id=1)  # changes of another instance are merged in the buffered one
+        other.send_lesson = True
+        chat_writes.add(other, ['send_lesson'])
+        self.assertIs(chat_writes.get(1), chat)
+        await chat_writes.flush()
+        self.assertIsNone(chat_writes.get(1))
+        chat = await Chat.objects.aget(chat_id=1)
+        self.assertEqual((chat.last_lesson_sent, chat.send_lesson), (5, True))
+
+    async def test_failed_flush_is_restored(self):
+        chat = await Chat.objects.acreate(chat_id=1)
+        chat.last_lesson_sent = 5
+        chat_writes.add(chat, ['last_lesson_sent'])
+        with mock.patch.object(Chat.objects, 'abulk_update', side_effect=Exception('database is locked')), \
+                self.assertLogs('lessons.write_buffer', 'ERROR'):
+            await chat_writes.flush()
+        self.assertEqual(chat_writes.get_fields(1), {'last_lesson_sent'})
+        await chat_writes.flush()
+        self.assertEqual((await Chat.objects.aget(chat_id=1)).last_lesson_sent, 5)
+
+    def test_restore_keeps_newer_changes(self):
+        chat = Chat(chat_id=1, last_lesson_sent=6, send_lesson=False)
+        chat_writes.add(chat, ['send_lesson'])  # changed while flushing
+        chat_writes.restore({('last_lesson_sent',): [chat]})
+        self.assertEqual(chat_writes.get_fields(1), {'send_lesson', 'last_lesson_sent'})
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, worker, age=0):
+        metrics.write_snapshot(self.directory, worker)
+        path = metrics.get_snapshot_path(self.directory, worker)
+        os.utime(path, (time.time() - age, time.time() - age))
+
+    def test_samples_are_labelled_by_worker(self):
+        metrics.messages_failed.inc(error='x')
+        metrics.update_wait_seconds.observe(1)
+        text = metrics.render('a')
+        self.assertIn('\nucdm_messages_sent_total{worker="a"} ', text)
+        self.assertIn('\nucdm_messages_failed_total{error="x",worker="a"} ', text)
+        self.assertIn('\nucdm_update_wait_seconds_bucket{le="+Inf",worker="a"} ', text)
+
+    def test_snapshots_of_the_workers_are_merged(self):
+        self.write('a')
+        self.write('b')
+        text = metrics.render_all(self.directory, 60, worker='web')
+        self.assertEqual(text.count('# TYPE ucdm_messages_sent_total counter'), 1)
+        for worker in ['a', 'b', 'web']:
+            self.assertIn(f'ucdm_messages_sent_total{{worker="{worker}"}} ', text)
+            self.assertIn(f'ucdm_metrics_timestamp_seconds{{worker="{worker}"}} ', text)
+
+    def test_old_snapshots_are_skipped(self):
+        self.write('a')
+        self.write('dead', age=120)
+        text = metrics.render_all(self.directory, 60, worker='web')
+        self.assertIn('worker="a"', text)
+        self.assertNotIn('worker="dead"', text)
+
+    async def test_view_serves_the_snapshots(self):
+        self.write('a')
+        with override_settings(METRICS_DIR=self.directory, WORKER_ID='web'):
+            response = await AsyncClient().get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ucdm_metrics_timestamp_seconds{worker="a"} ', response.content.decode())
+        self.assertIn('ucdm_metrics_timestamp_seconds{worker="web"} ', response.content.decode())
+
+    async def test_snapshot_is_removed_when_stopping(self):
+        task = asyncio.create_task(metrics.snapshot_loop(self.directory, 'a', 60))
+        await asyncio.sleep(0)
+        self.assertTrue(os.path.exists(metrics.get_snapshot_path(self.directory, 'a')))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+@override_settings(TELEGRAM_SECRET_TOKEN='secret')
+class WebhookTests(SimpleTestCase):
+    UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                          'text': '/start'}}
+
+    def setUp(self):
+        self.application = mock.Mock(update_queue=asyncio.Queue())
+        patch = mock.patch.object(bot, 'application', self.application)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def post(self, body, token='secret'):
+        return await AsyncClient().post(reverse('telegram_webhook'), body, content_type='application/json',
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': token})
+
+    async def test_update_is_queued(self):
+        response = await self.post(json.dumps(self.UPDATE))
+        self.assertEqual(response.status_code, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual((update.update_id, update.message.text), (1, '/start'))
+
+    async def test_wrong_secret_token_is_forbidden(self):
+        self.assertEqual((await self.post(json.dumps(self.UPDATE), token='wrong')).status_code, 403)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_invalid_update_is_a_bad_request(self):
+        invalid = {'update_id': 1, 'message': {'text': 'no date nor chat'}}
+        with self.assertLogs('lessons.views', 'WARNING'):
+            for body in ['not json', json.dumps(invalid), json.dumps([1])]:
+                self.assertEqual((await self.post(body)).status_code, 400, body)
+        self.assertTrue(self.application.update_queue.empty())
+
+    async def test_without_the_application_is_unavailable(self):
+        with mock.patch.object(bot, 'application', None):
+            self.assertEqual((await self.post(json.dumps(self.UPDATE))).status_code, 503)
+
+
+class PersistenceTests(TestCase):
+    def setUp(self):
+        self.persistence = DatabasePersistence()
+
+    async def write(self):
+        await self.persistence.write_task
+
+    async def test_conversation_states_are_stored(self):
+        await self.persistence.update_conversation('start', (1, 1), 2)
+        await self.persistence.update_conversation('start', (2, 2), 1)
+        await self.write()
+        await self.persistence.update_conversation('start', (2, 2), None)  # ended
+        await self.write()
+        self.assertEqual(await DatabasePersistence().get_conversations('start'), {(1, 1): 2})
+
+    async def test_timed_out_conversations_are_not_loaded(self):
+        await self.persistence.update_conversation('start', (1, 1), 2)
+        await self.write()
+        old = datetime.now(UTC) - timedelta(seconds=settings.CONVERSATION_TIMEOUT + 1)
+        await ConversationState.objects.aupdate(updated=old)
+        self.assertEqual(await DatabasePersistence().get_conversations('start'), {})
+        self.assertFalse(await ConversationState.objects.aexists())
+
+    async def test_chat_data_is_written_only_when_changed(self):
+        await self.persistence.update_chat_data(1, {'lesson': 3})
+        await self.write()
+        chat_data = {}
+        persistence = DatabasePersistence()
+        await persistence.refresh_chat_data(1, chat_data)
+        self.assertEqual(chat_data, {'lesson': 3})
+        await persistence.update_chat_data(1, chat_data)  # unchanged
+        self.assertIsNone(persistence.write_task)
+        await persistence.drop_chat_data(1)
+        await persistence.write_task
+        self.assertFalse(await ChatData.objects.aexists())
+
+
+class ChatCacheTests(SimpleTestCase):
+    def setUp(self):
+        chat_cache.clear()
+
+    def test_lru(self):
+        with override_settings(CHAT_CACHE_SIZE=2):
+            chat_cache.put(Chat(chat_id=1))
+            chat_cache.put(Chat(chat_id=2))
+            chat_cache.get(1)
+            chat_cache.put(Chat(chat_id=3))
+        self.assertIsNone(chat_cache.get(2))
+        self.assertEqual(chat_cache.get(1).chat_id, 1)
+        self.assertEqual(chat_cache.get(3).chat_id, 3)
+
+    def test_ttl(self):
+        with override_settings(CHAT_CACHE_TTL=10):
+            chat_cache.put(Chat(chat_id=1))
+        with mock.patch('lessons.chat_cache.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertIsNone(chat_cache.get(1))
+        self.assertNotIn(1, chat_cache.chats)
+
+    def test_refresh_only_cached_chats(self):
+        chat_cache.refresh(Chat(chat_id=1))
+        self.assertIsNone(chat_cache.get(1))
+        chat_cache.put(Chat(chat_id=1))
+        newer = Chat(chat_id=1)
+        chat_cache.refresh(newer)
+        self.assertIs(chat_cache.get(1), newer)
+
+
+class DeadChatTests(SimpleTestCase):
+    def test_dead_chat_reason(self):
+        self.assertEqual(bot.get_dead_chat_reason(Forbidden('Forbidden: bot was blocked by the user')), 'blocked')
+        self.assertEqual(bot.get_dead_chat_reason(Forbidden('Forbidden: user is deactivated')), 'deactivated')
+        self.assertEqual(bot.get_dead_chat_reason(BadRequest('Chat not found')), 'not_found')
+        self.assertIsNone(bot.get_dead_chat_reason(BadRequest('Message is too long')))
+
+
+class ThrottledAdminEmailTests(SimpleTestCase):
+    def record(self, lineno):
+        return logging.LogRecord('lessons.bot', logging.ERROR, 'bot.py', lineno, 'error', None, None)
+
+    def test_should_send(self):
+        handler = ThrottledAdminEmailHandler(interval=60, max_emails=2)
+        with mock.patch('lessons.log.time.monotonic', return_value=1000):
+            self.assertTrue(handler.should_send(self.record(1)))
+            self.assertFalse(handler.should_send(self.record(1)))  # same place
+            self.assertTrue(handler.should_send(self.record(2)))
+            self.assertFalse(handler.should_send(self.record(3)))  # too many in the interval
+        with mock.patch('lessons.log.time.monotonic', return_value=1060):
+            self.assertTrue(handler.should_send(self.record(1)))
+            self.assertTrue(handler.should_send(self.record(3)))
+
+
+class SendPlanTests(SimpleTestCase):
+    def test_lesson_number(self):
+        plan = SendPlan(TODAY)
+        self.assertEqual(plan.get_lesson_number(Chat(is_calendar=True)), 68)  # March 10th
+        self.assertEqual(plan.get_lesson_number(Chat(is_calendar=False)), 0)
+        self.assertEqual(plan.get_lesson_number(Chat(is_calendar=False, last_lesson_sent=9)), 10)
+        self.assertEqual(plan.get_lesson_number(Chat(is_calendar=False, last_lesson_sent=364)), 0)  # starts again
+        self.assertEqual(SendPlan(datetime(2028, 12, 31).date()).get_lesson_number(Chat(is_calendar=True)), 364)
+
+
+@override_settings(LESSON_STORAGE_CHANNEL=None, TELEGRAM_RATE_LIMIT=1000)
+class SendLessonTests(TestCase):
+    LESSON = (LessonMessage('Lección 1'), LessonMessage('Nada real puede ser amenazado'))
+
+    def setUp(self):
+        chat_writes.pending.clear()
+        deliveries.pending.clear()
+        deliveries.preloaded.clear()
+        self.fake = FakeTelegramServer().start()
+        self.addCleanup(self.fake.stop)
+        workbook_patch = mock.patch.object(workbook, 'workbook_messages', {'es': (self.LESSON,) * 365})
+        workbook_patch.start()
+        self.addCleanup(workbook_patch.stop)
+
+    async def send(self, chat):
+        async with ExtBot('123:TEST', base_url=self.fake.base_url, rate_limiter=TelegramRateLimiter()) as broadcast_bot:
+            with mock.patch.object(bot, 'broadcast_bot', broadcast_bot):
+                return await bot.send_lesson(chat, 0, language='es', plan=SendPlan(TODAY))
+
+    async def test_sends_the_parts(self):
+        chat = await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        self.assertEqual(await self.send(chat), 2)
+        self.assertEqual(self.fake.sent[1], 2)
+        self.assertEqual((chat.last_sent, chat.last_lesson_sent), (TODAY, 0))
+        self.assertEqual(await deliveries.get_sent_parts(chat, TODAY, 0), {0, 1})
+        self.assertEqual(await Delivery.objects.filter(chat=chat).acount(), 2)  # written before counting as sent
+
+    async def test_resumes_after_the_sent_parts(self):
+        chat = await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        deliveries.add(chat, TODAY, 0, 0, message_id=10)  # sent before a restart
+        with self.assertLogs('lessons.bot', 'INFO') as logs:
+            self.assertEqual(await self.send(chat), 1)
+        self.assertIn('Resuming lesson 1, 1 parts already sent', logs.output[0])
+        self.assertEqual(self.fake.sent[1], 1)
+
+    @override_settings(LESSON_STORAGE_CHANNEL=-100)
+    async def test_lesson_is_copied_from_the_storage_channel(self):
+        lesson_storage.stored_lessons.clear()
+        self.addCleanup(lesson_storage.stored_lessons.clear)
+        chats = [await Chat.objects.acreate(chat_id=chat_id, send_lesson=True) for chat_id in (1, 2)]
+        for chat in chats:
+            self.assertEqual(await self.send(chat), 2)
+        self.assertEqual(self.fake.sent[-100], 2)  # posted once
+        self.assertEqual((self.fake.requests['sendMessage'], self.fake.requests['copyMessages']), (2, 2))
+        self.assertEqual((self.fake.sent[1], self.fake.sent[2]), (2, 2))
+        self.assertEqual(await StoredLesson.objects.filter(channel_id=-100, lesson_number=0).acount(), 2)
+
+    async def test_flood_control_is_retried(self):
+        self.fake.retry_after_rate = 1
+        chat = await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        self.assertEqual(await self.send(chat), 0)
+        parts = [p async for p in PendingMessage.objects.filter(chat=chat).values_list('part', 'date')]
+        self.assertEqual(sorted(parts), [(0, TODAY), (1, TODAY)])
+        self.assertTrue(chat.send_lesson)
+
+    async def test_retried_part_is_recorded_on_the_lesson_date(self):
+        chat = await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        pending = await PendingMessage.objects.acreate(chat=chat, date=TODAY, lesson_number=0, language='es', part=1,
+                                                       next_attempt=datetime.now(UTC))
+        async with ExtBot('123:TEST', base_url=self.fake.base_url, rate_limiter=TelegramRateLimiter()) as broadcast_bot:
+            with mock.patch.object(bot, 'broadcast_bot', broadcast_bot), \
+                    mock.patch.object(bot, 'get_chat_now', return_value=datetime(2026, 3, 11, 1, tzinfo=UTC)):
+                self.assertEqual(await retry_queue.retry_messages(chat, [pending]), 1)
+        self.assertEqual(await Delivery.objects.filter(chat=chat, date=TODAY, part=1).acount(), 1)
+        self.assertFalse(await PendingMessage.objects.aexists())
+
+    async def test_preloaded_chats_are_bounded(self):
+        chats = [await Chat.objects.acreate(chat_id=chat_id) for chat_id in range(1, 6)]
+        with override_settings(SEND_CHUNK_SIZE=2):
+            await deliveries.preload(chats[:3], TODAY)
+            await deliveries.preload(chats[3:], TODAY)
+        self.assertEqual(list(deliveries.preloaded), [(chat.pk, TODAY) for chat in chats[1:]])
+
+    async def test_blocked_chat_is_disabled(self):
+        self.fake.blocked.add(1)
+        chat = await Chat.objects.acreate(chat_id=1, send_lesson=True)
+        self.assertEqual(await self.send(chat), 0)
+        self.assertFalse(chat.send_lesson)
+        self.assertIn('send_lesson', chat_writes.get_fields(1))
+        self.assertFalse(await PendingMessage.objects.aexists())
+
+    async def test_migrated_chat_continues_in_the_supergroup(self):
+        self.fake.migrated[-1] = -1001
+        chat = await Chat.objects.acreate(chat_id=-1, is_group=True, send_lesson=True)
+        await self.send(chat)
+        self.assertEqual((await Chat.objects.aget(pk=chat.pk)).chat_id, -1001)
+        self.assertEqual(await PendingMessage.objects.filter(chat=chat).acount(), 2)  # sent to the supergroup later
+        self.assertTrue(chat.send_lesson)
+
+
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.sending = asyncio.Event()
+        self.sends = []  # chat_id, 'sent' or 'cancelled'
+        for name, function in [('try_send_all', self.send_all), ('get_next_send_all_time', self.next_send_all),
+                               ('send_today_if_due', self.send_chat)]:
+            patcher = mock.patch.object(bot, name, function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def send_all(self):
+        pass
+
+    async def next_send_all(self, now):
+        return now + timedelta(days=1)
+
+    async def send_chat(self, chat_id):
+        self.sending.set()
+        try:
+            await asyncio.sleep(0.2 if chat_id == 'slow' else 0)
+            self.sends.append((chat_id, 'sent'))
+            return 1
+        except asyncio.CancelledError:
+            self.sends.append((chat_id, 'cancelled'))
+            raise
+
+    async def test_woken_chats_are_sent(self):
+        scheduler = Scheduler()
+        run = asyncio.create_task(scheduler.run())
+        scheduler.wake(1, delay=0)
+        scheduler.wake(2, delay=0.05)
+        await asyncio.sleep(0.2)
+        run.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await run
+        self.assertEqual(self.sends, [(1, 'sent'), (2, 'sent')])
+
+    async def test_cancelling_waits_for_the_sends(self):
+        scheduler = Scheduler()
+        run = asyncio.create_task(scheduler.run())
+        scheduler.wake('slow', delay=0)
+        await asyncio.wait_for(self.sending.wait(), 1)
+        run.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await run
+        self.assertEqual(self.sends, [('slow', 'cancelled')])  # before run returned, so before the flush
+        self.assertFalse(scheduler.tasks)
+
+    async def test_cancelling_dispatch_cancels_the_chats(self):
+        task = asyncio.create_task(dispatch(['slow', 'slow', 'slow'], self.send_chat, concurrency=2))
+        await asyncio.wait_for(self.sending.wait(), 1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(self.sends, [('slow', 'cancelled')] * 2)
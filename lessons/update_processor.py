@@ -0,0 +1,101 @@
+import time
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from django.conf import settings
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from . import metrics
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes the updates of different chats concurrently, up to UPDATE_CONCURRENCY at a time, and the updates of
+    the same chat one after the other in the order they were received, so the conversation states stay correct.
+    The chat lock is taken before the concurrency slot, so a chat sending many updates only takes one slot.
+    """
+    def __init__(self):
+        # the base semaphore is taken before the chat lock, so it can't be the concurrency limit or a chat with many
+        # updates would take all of it. UpdateQueue keeps the updates below it.
+        super().__init__(max_concurrent_updates=settings.UPDATE_MAX_PENDING)
+        self.slots = asyncio.Semaphore(settings.UPDATE_CONCURRENCY)
+        self.chat_locks = {}  # chat_id -> lock, while the chat has updates waiting or being processed
+        self.chat_updates = Counter()  # chat_id -> updates waiting or being processed
+
+    async def do_process_update(self, update, coroutine):
+        start = time.monotonic()
+        waiting = True
+        metrics.updates_waiting.inc()
+        try:
+            async with self.lock_chat(get_chat_id(update)), self.slots:
+                waiting = False
+                metrics.updates_waiting.dec()
+                metrics.update_wait_seconds.observe(time.monotonic() - start)
+                metrics.updates_processing.inc()
+                try:
+                    await coroutine
+                finally:
+                    metrics.updates_processing.dec()
+        finally:
+            if waiting:  # cancelled before being processed
+                metrics.updates_waiting.dec()
+
+    @asynccontextmanager
+    async def lock_chat(self, chat_id):
+        if chat_id is None:
+            yield
+            return
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        self.chat_updates[chat_id] += 1
+        try:
+            async with lock:  # waiters acquire it in order
+                yield
+        finally:
+            self.chat_updates[chat_id] -= 1
+            if not self.chat_updates[chat_id]:
+                del self.chat_updates[chat_id]
+                del self.chat_locks[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    The application takes the updates out of its queue as soon as they arrive and waits for them in tasks, so the
+    queue alone doesn't limit them. put() waits while max_pending updates are queued or being processed, so the
+    updater stops fetching updates and the webhook stops answering until the handlers catch up.
+    """
+    def __init__(self, max_pending):
+        super().__init__()
+        self.max_pending = max_pending
+        self.pending = 0  # put and not marked as done yet
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+
+    async def put(self, item):
+        while self.pending >= self.max_pending:
+            self.has_room.clear()
+            await self.has_room.wait()
+        self.pending += 1
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self.pending -= 1
+        if self.pending < self.max_pending:
+            self.has_room.set()
+
+
+def get_chat_id(update):
+    """Updates without a chat, like inline queries, are ordered by user"""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
@@ -0,0 +1,39 @@
+import json
+import logging
+from secrets import compare_digest
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from telegram import Update
+
+from . import bot as bot_module, metrics
+
+logger = logging.getLogger(__name__)
+
+
+@csrf_exempt
+@require_POST
+async def telegram_webhook(request):
+    secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not settings.TELEGRAM_SECRET_TOKEN or not compare_digest(secret_token, settings.TELEGRAM_SECRET_TOKEN):
+        logger.warning('Webhook request with wrong secret token')
+        return HttpResponseForbidden()
+    if not bot_module.application:
+        return HttpResponse(status=503)
+    try:
+        update = Update.de_json(json.loads(request.body), bot_module.bot)
+    except (ValueError, LookupError, AttributeError, TypeError) as e:  # not json, or not a valid update
+        logger.warning(f'Webhook request with an invalid update: {e!r}')
+        return HttpResponseBadRequest()
+    await bot_module.application.update_queue.put(update)
+    return HttpResponse()
+
+
+async def metrics_view(_):
+    """
+    Metrics of this process, where the bot runs in webhook mode, merged with the last snapshots written by the
+    bot processes and workers in polling mode, labelled by worker.
+    """
+    text = metrics.render_all(settings.METRICS_DIR, settings.METRICS_MAX_AGE, worker=settings.WORKER_ID)
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
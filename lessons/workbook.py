@@ -1,37 +1,109 @@
 import os
 import json
-from collections import defaultdict
+import pickle
+import logging
 from datetime import date
 from django.conf import settings
 
-workbook_structure = None
-workbook_cache = defaultdict(dict)
+from .markdown import LessonMessage, compile_texts
+
+logger = logging.getLogger(__name__)
+
 WORKBOOK_PATH = os.path.join(settings.BASE_DIR, 'acim_workbook')
+CACHE_VERSION = 2
+
+workbook_structure = None
+workbook_messages = {}  # language -> tuple with the LessonMessages of each day, ready to send
 
 
 def get_day_texts(day: int, language=None) -> list[str]:
     """
+    Reads the lesson files from disk, use get_lesson_messages for sending.
     :param day: 0-based lesson day
     :param language: the language to retrieve, defaults to settings.WORKBOOK_LANGUAGE
     """
     if language is None:
         language = settings.WORKBOOK_LANGUAGE
+    rv = []
+    for file in get_workbook_structure()[day]:
+        with open(f'{WORKBOOK_PATH}/{language}/{file}') as f:
+            rv.append(f.read())
+    return rv
 
-    if day in workbook_cache[language]:
-        return workbook_cache[language][day]
 
+def get_workbook_structure():
     global workbook_structure
     if not workbook_structure:
         with open(f'{WORKBOOK_PATH}/workbook_structure.json') as f:
             workbook_structure = json.loads(f.read())
+    return workbook_structure
 
-    rv = []
-    for file in workbook_structure[day]:
-        with open(f'{WORKBOOK_PATH}/{language}/{file}') as f:
-            text = f.read()
-            rv.append(text)
-    workbook_cache[language][day] = rv
-    return rv
+
+def get_lesson_messages(day: int, language=None) -> tuple[LessonMessage, ...]:
+    """
+    :param day: 0-based lesson day
+    :param language: the language to retrieve, defaults to settings.WORKBOOK_LANGUAGE
+    :return: the texts of the lesson with their entities, joined and split in messages that fit in telegram
+    """
+    if language is None:
+        language = settings.WORKBOOK_LANGUAGE
+    if language not in workbook_messages:
+        compile_workbook()
+    return workbook_messages[language][day]
+
+
+def get_languages() -> list[str]:
+    return sorted(entry.name for entry in os.scandir(WORKBOOK_PATH) if entry.is_dir() and not entry.name.startswith('.'))
+
+
+def compile_workbook(cache_file=None):
+    """
+    Loads every lesson of every language and compiles them to telegram messages, all at once.
+    If a cache file is given, the compiled workbook is read from it when up to date, or written to it otherwise.
+    """
+    global workbook_messages
+    signature = get_workbook_signature()
+    if cache_file:
+        cached = read_compiled_workbook(cache_file, signature)
+        if cached:
+            workbook_messages = cached
+            return
+
+    interned = {}  # equal messages share the same instance
+    compiled = {}
+    for language in get_languages():
+        compiled[language] = tuple(
+            tuple(interned.setdefault(message, message) for message in compile_texts(get_day_texts(day, language)))
+            for day in range(len(get_workbook_structure()))
+        )
+    message_count = sum(len(day) for days in compiled.values() for day in days)
+    logger.info(f'Compiled workbook - {len(compiled)} languages, {message_count} messages')
+    workbook_messages = compiled
+
+    if cache_file:
+        with open(cache_file, 'wb') as f:
+            pickle.dump((CACHE_VERSION, signature, compiled), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_compiled_workbook(cache_file, signature):
+    try:
+        with open(cache_file, 'rb') as f:
+            version, cached_signature, compiled = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, ValueError, EOFError):
+        return None
+    if version != CACHE_VERSION or cached_signature != signature:
+        logger.info('Compiled workbook cache is outdated')
+        return None
+    logger.info(f'Loaded compiled workbook from {cache_file}')
+    return compiled
+
+
+def get_workbook_signature():
+    """Sizes and modification times of all the workbook files, to know when the compiled workbook is outdated"""
+    entries = [('workbook_structure.json', os.stat(f'{WORKBOOK_PATH}/workbook_structure.json'))]
+    for language in get_languages():
+        entries += [(f'{language}/{e.name}', e.stat()) for e in os.scandir(f'{WORKBOOK_PATH}/{language}')]
+    return tuple(sorted((name, stat.st_size, stat.st_mtime_ns) for name, stat in entries))
 
 
 def get_day_lesson_number(today: date) -> int:
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import defaultdict
+from django.conf import settings
+
+from .models import Chat
+from .chat_cache import chat_cache
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWriteBuffer:
+    """
+    Collects changes to chats and writes them with bulk updates, on an interval or when the buffer is full.
+    While a chat has pending changes, get() returns the buffered instance so that readers see the latest state.
+    """
+    def __init__(self):
+        self.pending = {}  # chat_id -> (chat, fields)
+        self.flushing = {}  # changes being written
+        self.lock = asyncio.Lock()
+
+    def get(self, chat_id) -> Chat | None:
+        entry = self.pending.get(chat_id) or self.flushing.get(chat_id)
+        return entry and entry[0]
+
+    def get_fields(self, chat_id) -> set[str]:
+        """Fields of the chat changed in this process and not yet written"""
+        fields = set()
+        for entry in (self.pending.get(chat_id), self.flushing.get(chat_id)):
+            if entry:
+                fields.update(entry[1])
+        return fields
+
+    def add(self, chat, fields):
+        entry = self.pending.get(chat.chat_id)
+        if entry is None:
+            self.pending[chat.chat_id] = (chat, set(fields))
+        else:
+            buffered, buffered_fields = entry
+            if buffered is not chat:
+                for field in fields:
+                    setattr(buffered, field, getattr(chat, field))
+            buffered_fields.update(fields)
+        chat_cache.refresh(self.get(chat.chat_id))
+        if len(self.pending) >= settings.WRITE_BUFFER_SIZE and not self.lock.locked():
+            asyncio.create_task(self.flush())
+
+    def rename(self, old_chat_id, chat):
+        """Call after changing the chat_id of a chat, so its pending changes are found by the new id"""
+        entry = self.pending.pop(old_chat_id, None)
+        if entry:
+            self.pending[chat.chat_id] = entry
+
+    def discard(self, chat, fields):
+        """Call after saving fields of the chat, so the pending changes are not written again"""
+        entry = self.pending.get(chat.chat_id)
+        if entry:
+            entry[1].difference_update(fields)
+            if not entry[1]:
+                del self.pending[chat.chat_id]
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            self.flushing = pending
+            by_fields = defaultdict(list)
+            for chat, fields in pending.values():
+                by_fields[tuple(sorted(fields))].append(chat)
+            unwritten = dict(by_fields)
+            try:
+                for fields, chats in by_fields.items():
+                    try:
+                        await Chat.objects.abulk_update(chats, fields, batch_size=settings.WRITE_BUFFER_SIZE)
+                        del unwritten[fields]
+                    except Exception as e:
+                        logger.exception(f'Error writing {len(chats)} chats: {e}')
+            finally:
+                self.flushing = {}
+                self.restore(unwritten)
+            logger.debug(f'Wrote {len(pending)} chats')
+
+    def restore(self, unwritten):
+        for fields, chats in unwritten.items():
+            for chat in chats:
+                if chat.chat_id in self.pending:  # changed again while flushing, keep the newest values
+                    self.pending[chat.chat_id][1].update(fields)
+                else:
+                    self.pending[chat.chat_id] = (chat, set(fields))
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.WRITE_BUFFER_INTERVAL)
+            await self.flush()
+
+
+chat_writes = ChatWriteBuffer()
+
+metrics.Gauge('ucdm_write_buffer_chats', 'Chats with changes waiting to be written', function=lambda: len(chat_writes.pending))
@@ -1,9 +1,16 @@
-#!/usr/bin/env -S PYENV_VERSION=ucdm DJANGO_SETTINGS_MODULE=ucdm_bot.settings PRODUCTION=true python
+#!/usr/bin/env -S PYENV_VERSION=ucdm DJANGO_SETTINGS_MODULE=ucdm_bot.settings_bot PRODUCTION=true python
+from lessons.startup import startup_timer
 import asyncio
+import argparse
 import django
 django.setup()
+startup_timer.phase('django')
 
 from lessons.bot_loop import run_bot_loop
+startup_timer.phase('imports')
 
 if __name__ == '__main__':
-    asyncio.run(run_bot_loop())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', action='store_true', help='only send lessons, several workers can run at once')
+    args = parser.parse_args()
+    asyncio.run(run_bot_loop(worker=args.worker))
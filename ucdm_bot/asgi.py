@@ -3,6 +3,9 @@ ASGI config for ucdm_bot project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+When settings.TELEGRAM_WEBHOOK is set, the bot is started and stopped with the
+server through the ASGI lifespan protocol, sharing its event loop.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -13,4 +16,31 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ucdm_bot.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def lifespan(receive, send):
+    from django.conf import settings
+    from lessons.bot_loop import start_webhook_bot, stop_webhook_bot
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                if settings.TELEGRAM_WEBHOOK:
+                    await start_webhook_bot()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                raise
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if settings.TELEGRAM_WEBHOOK:
+                await stop_webhook_bot()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -1,4 +1,5 @@
 import os
+import socket
 from pathlib import Path
 from marto_python.secrets import read_secrets, get_secret
 
@@ -12,10 +13,60 @@ DEBUG = not get_secret('PRODUCTION', default=False)
 SECRET_KEY = get_secret('DJANGO_SECRET_KEY')
 
 WORKBOOK_LANGUAGE = get_secret('WORKBOOK_LANGUAGE', 'es')
+WORKBOOK_CACHE_FILE = os.path.join(BASE_DIR, 'workbook.pickle')  # compiled workbook, None to always compile
 
 TELEGRAM_TOKEN = get_secret('TELEGRAM_TOKEN')
+TELEGRAM_BASE_URL = get_secret('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
 TELEGRAM_WEBHOOKS_SERVER = 'https://localhost.multilanguage.xyz'
 TELEGRAM_SECRET_TOKEN = get_secret('TELEGRAM_SECRET_TOKEN')
+TELEGRAM_WEBHOOK = get_secret('TELEGRAM_WEBHOOK', default=False)  # receive updates in the ASGI app instead of polling
+TELEGRAM_RATE_LIMIT = 30  # messages per second, for the whole bot. Divide it among the processes sending lessons
+TELEGRAM_CHAT_RATE_LIMIT = 1  # messages per second, to the same chat
+TELEGRAM_GROUP_RATE_LIMIT = 20 / 60  # messages per second, to the same group
+TELEGRAM_POOL_SIZE = 16  # connections for the update handlers
+TELEGRAM_BROADCAST_POOL_SIZE = 64  # connections for sending lessons, more than BROADCAST_CONCURRENCY
+TELEGRAM_HTTP_VERSION = '1.1'  # '2' needs python-telegram-bot[http2]
+TELEGRAM_CONNECT_TIMEOUT = 5  # seconds
+TELEGRAM_READ_TIMEOUT = 10
+TELEGRAM_WRITE_TIMEOUT = 10
+TELEGRAM_POOL_TIMEOUT = 10
+LESSON_STORAGE_CHANNEL = get_secret('LESSON_STORAGE_CHANNEL')  # private channel to copy the lessons from, optional
+
+SEND_LESSONS = get_secret('SEND_LESSONS', default=True)  # run the scheduler in this process
+WORKER_ID = get_secret('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')[:64]  # owner of the chat leases
+LEASE_TTL = 15 * 60  # seconds a worker holds the due chats it claimed, longer than sending SEND_CHUNK_SIZE chats
+BROADCAST_CONCURRENCY = 50  # chats being sent to at the same time
+SEND_CHUNK_SIZE = 500  # chats loaded from the database at a time
+WRITE_BUFFER_SIZE = 200  # chat changes buffered before writing them
+WRITE_BUFFER_INTERVAL = 5  # seconds between writes of buffered chat changes
+DELIVERY_WRITE_DELAY = 0.1  # seconds the sent lesson parts of the chats sent at the same time are collected
+DELIVERY_RETENTION_DAYS = 7  # days the log of sent lesson parts is kept
+CHAT_CACHE_SIZE = 10000  # chats kept in memory
+CHAT_CACHE_TTL = 5 * 60  # seconds, so changes from other processes are seen
+
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')  # snapshots written by the bot processes, served by /metrics
+METRICS_INTERVAL = 15  # seconds between metrics snapshots
+METRICS_MAX_AGE = 4 * METRICS_INTERVAL  # seconds, older snapshots are of processes that died
+
+SCHEDULER_WAKE_DELAY = 3  # seconds before sending the lesson after changing the lesson settings
+SCHEDULER_START_DELAY = 10 * 60  # seconds before sending the lesson after /start, if no mode was chosen
+SCHEDULER_RESCAN_INTERVAL = 60 * 60  # seconds between checks for due chats during the send hours
+
+RETRY_BASE_DELAY = 30  # seconds, doubled on every failed attempt
+RETRY_MAX_DELAY = 60 * 60
+RETRY_MAX_ATTEMPTS = 10
+RETRY_POLL_INTERVAL = 60
+CHAT_MAX_FAILURES = 7  # lessons in a row that failed before the chat stops receiving them
+
+BOT_JOB_CONCURRENCY = 10  # chats handled at the same time by an admin job
+BOT_JOB_POLL_INTERVAL = 5  # seconds between checks for new admin jobs
+BOT_JOB_PROGRESS_INTERVAL = 2  # seconds between saves of the progress of a running job
+BOT_JOB_LEASE_TTL = 60  # seconds without saving progress before another process resumes a running job
+
+UPDATE_CONCURRENCY = 32  # updates of different chats processed at the same time
+UPDATE_MAX_PENDING = 1000  # updates received and not processed yet, before the bot stops fetching more
+CONVERSATION_TIMEOUT = 10 * 60  # seconds a user has to answer the /start, /modo and /idioma questions
+PERSISTENCE_INTERVAL = 10  # seconds between writes of the conversation states and chat data
 
 DEFAULT_FROM_EMAIL = 'UCDM <ucdm@multilanguage.xyz>'
 SERVER_EMAIL = 'UCDM - Server <ucdm@multilanguage.xyz>'
@@ -74,12 +125,36 @@ TEMPLATES = [
 WSGI_APPLICATION = 'ucdm_bot.wsgi.application'
 
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+DATABASE_ENGINE = get_secret('DATABASE_ENGINE', 'sqlite')  # sqlite for small deployments, or postgresql
+DATABASE_POOL_SIZE = 10  # postgresql connections per process
+
+if DATABASE_ENGINE == 'postgresql':  # needs psycopg[pool]
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': get_secret('DATABASE_NAME', 'ucdm'),
+            'USER': get_secret('DATABASE_USER', 'ucdm'),
+            'PASSWORD': get_secret('DATABASE_PASSWORD'),
+            'HOST': get_secret('DATABASE_HOST', 'localhost'),
+            'PORT': get_secret('DATABASE_PORT', '5432'),
+            'OPTIONS': {
+                'pool': {'min_size': 2, 'max_size': DATABASE_POOL_SIZE, 'timeout': 10},
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # readers don't block the writer, and writers wait for the lock instead of failing
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'timeout': 20,  # seconds, the busy timeout
+                'transaction_mode': 'IMMEDIATE',  # take the write lock when the transaction starts, to avoid deadlocks
+            },
+        }
     }
-}
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -114,24 +189,31 @@ LOGGING = {
         },
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'logging.handlers.WatchedFileHandler',  # several processes write it, logrotate rotates it
             'filename': os.path.join(BASE_DIR, 'ucdm.log'),
             'formatter': 'simple_time',
         },
         'mail_admins': {
             'level': 'ERROR',
-            'class': 'django.utils.log.AdminEmailHandler',
+            'class': 'lessons.log.ThrottledAdminEmailHandler',
             'filters': ['require_debug_false'],
+            'interval': 10 * 60,  # seconds before mailing the same error again
+            'max_emails': 10,  # per interval
+        },
+        'queue': {  # writes to the other handlers from a thread, started by lessons.log.start_log_listener
+            'class': 'lessons.log.LocalQueueHandler',
+            'handlers': ['console', 'file', 'mail_admins'],
+            'respect_handler_level': True,
         },
     },
     'loggers': {
         'httpx': {
-            'handlers': ['console', 'mail_admins', 'file'],
+            'handlers': ['queue'],
             'level': 'WARNING',
             'propagate': False,
         },
         'root': {
-            'handlers': ['console', 'file', 'mail_admins'],
+            'handlers': ['queue'],
             'level': 'INFO',
         },
     }
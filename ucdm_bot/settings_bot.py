@@ -0,0 +1,13 @@
+"""
+Settings for the bot process (ucdm.py), which only needs the lessons app.
+Leaving out the admin and the rest of the web apps makes the startup faster.
+The web process, including the webhook mode, uses the full settings.
+"""
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'lessons',
+]
+
+MIDDLEWARE = []
+TEMPLATES = []
@@ -1,7 +1,13 @@
-from django.contrib import admin
+from django.apps import apps
 from django.urls import path
+from lessons import views
 
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    path('telegram/webhook/', views.telegram_webhook, name='telegram_webhook'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
+
+if apps.is_installed('django.contrib.admin'):  # not in the bot settings, see settings_bot
+    from django.contrib import admin
+    urlpatterns.insert(0, path('admin/', admin.site.urls))